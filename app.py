@@ -1,411 +1,1819 @@
 import os
 import sys
-import numpy as np
-import pandas as pd
-import matplotlib.image as mpimg
-from PyQt5 import QtCore, QtGui, QtWidgets
-from scipy.optimize import curve_fit
-from scipy import ndimage
-from pyexiv2 import Image
 import json
 import configparser
+import re
+import hashlib
+import struct
+import argparse
+import threading
+import time
+import importlib
+import multiprocessing
+import platform
+import cProfile
+import pstats
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from fractions import Fraction
+from functools import lru_cache
+try:
+    import resource
+except ImportError:  # not available on Windows, CPU time falls back to time.process_time and peak RSS is not reported
+    resource = None
 
-centers = []  # list to store vignette centers as "x;y" strings
-coefficients = []  # list to store vignette coefficients as "1.1;2.2;3.3;4.4;5.5;6.6" strings
 
+class LazyModule(object):
+    """
+    Module imported on first attribute access, keeps startup of the command line fast
+    """
+
+    def __init__(self, name):
+        """
+        :param name: full module name
+        """
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)  # import lock makes concurrent first use safe
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+# numerical and metadata libraries take most of the startup time and are imported when the calibration needs them
+np = LazyModule("numpy")
+ndimage = LazyModule("scipy.ndimage")
+optimize = LazyModule("scipy.optimize")
+pyexiv2 = LazyModule("pyexiv2")
+PILImage = LazyModule("PIL.Image")
+
+FIT_MODES = ("binned", "curve_fit")  # polynomial approximation modes, see fit_poly6
+FIT_MODE = "binned"
+CENTER_MODES = ("com", "joint")  # vignette center search modes, see calibrate_band
+CENTER_MODE = "com"
+PYRAMID_FACTOR = 8  # downsampling factor of the coarse center search
+FIT_TOLERANCE = 1e-4  # largest curve difference from the reference fit considered negligible
+META_CACHE = ".vignette_meta.json"  # name of metadata index cache stored in the images directory
+START_METHOD = "spawn"  # worker processes start method, forking the threaded GUI process may deadlock children
+META_VERSION = 1  # increase when read_meta records or metadata cache layout change
+META_WORKERS = 8  # threads reading image headers
+# TIFF tags needed to locate pixel data, and value formats of TIFF field types (rationals are two values)
+TIFF_TAGS = {256: "width", 257: "height", 258: "bits", 259: "compression", 273: "offsets", 274: "orientation",
+             277: "samples", 279: "byte_counts", 339: "sample_format", 50714: "blacklevel"}
+TIFF_TYPES = {1: "B", 3: "H", 4: "I", 5: "II", 6: "b", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d", 16: "Q"}
+# Orientation tag values as (transpose, rows step, columns step) of the stored pixels view
+TIFF_ORIENTATIONS = {1: (False, 1, 1), 2: (False, 1, -1), 3: (False, -1, -1), 4: (False, -1, 1),
+                     5: (True, 1, 1), 6: (True, 1, -1), 7: (True, -1, -1), 8: (True, -1, 1)}
+AVERAGE_MODES = ("mean", "clipped")  # frame averaging modes, see calibrate_band
+AVERAGE_MODE = "mean"
+CLIP_SIGMA = 3.0  # pixels further than CLIP_SIGMA deviations from the median of the stack are rejected
+CLIP_ITERATIONS = 5  # largest number of sigma clipping passes
+CLIP_FLOOR = 1.0  # smallest deviation in DN, so quantized noise-free pixels are not rejected for 1 DN difference
+CLIP_TILE = 16 * 1024 ** 2  # bytes of one frame stack tile with temporary arrays, small tiles stay in CPU caches
+REJECT_LIMIT = 0.5  # frames with larger fraction of rejected pixels are reported as bad captures
+TILE_WORKERS = None  # threads clipping tiles in parallel, None for all CPU cores
+DEVIGNETTE_WORKERS = None  # threads correcting images, None for all CPU cores
+READ_AHEAD = 4  # images read into memory ahead of the correction
+DEVIGNETTE_ROWS = 256  # rows corrected at once, keeps float32 temporaries small
+REPORT_FILE = "calibration_report.json"  # resource usage report saved next to tags.json
+PROFILE_ENV = "VIGNETTE_PROFILE"  # environment variable with directory for GUI run profiles, profiling is off if unset
+PROFILE_TOP = 40  # functions and allocation sites listed in the readable profile
+STAGE_NAMES = {"scan": "метаданные", "calibrate": "калибровка", "total": "всего", "cache": "кэш",
+               "average": "усреднение", "center": "центр", "profile": "профиль", "fit": "аппроксимация"}
+BAND_JOBS = None  # processes calibrating bands in parallel, None for all CPU cores, 1 for serial processing
+STATE_FILE = ".vignette_state_{}.npz"  # per-band averaging state stored in the images directory
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vignette_finder")  # calibration results cache
+CACHE_SIZE = 1024 ** 3  # cache size limit in bytes, least recently used entries are evicted above it
+CACHE_VERSION = 3  # increase when cached results format or calibration algorithm changes
+
+
+class UsageMeter(object):
+    """
+    Per-stage resource usage of the current process: wall time, CPU time (including finished child processes), bytes
+    read by read calls and from storage (Linux only, None elsewhere), frame bytes memory-mapped by tiff_view and peak
+    resident set size. Memory-mapped frames are not read by read calls, so their pixel bytes are counted when they are
+    mapped. On Linux the kernel RSS high-water mark is reset at every stage end, so peak RSS belongs to the stage; peaks
+    seen before resets are kept, so stages of nested meters still cover the stages of inner ones. Elsewhere peak RSS is
+    the process high-water mark and only grows from stage to stage
+    """
+    lock = threading.Lock()
+    mapped = 0  # bytes of frame pixels mapped for reading by tiff_view in this process
+    peaks = []  # RSS high-water marks observed right before every reset
+
+    def __init__(self):
+        self.stages = {}
+        self.start = self.snapshot()
+        self.mark = self.start
+
+    @classmethod
+    def count_mapped(cls, size):
+        """
+        :param size: bytes of pixels mapped for reading
+        """
+        with cls.lock:
+            cls.mapped += size
+
+    @classmethod
+    def snapshot(cls):
+        """
+        Sample the counters and reset the RSS high-water mark where the system allows it
+        :return: dictionary with absolute wall time, CPU time, read counters, mapped bytes, peak RSS in bytes and the
+        number of high-water mark resets done so far
+        """
+        sample = {"wall": time.perf_counter(), "cpu": time.process_time(), "read_chars": None, "read_bytes": None,
+                  "mapped_bytes": cls.mapped, "peak_rss": None}
+        if resource is not None:
+            own = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            sample["cpu"] = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+            sample["peak_rss"] = own.ru_maxrss * (1 if sys.platform == "darwin" else 1024)  # kilobytes on Linux
+        try:
+            with open("/proc/self/io") as f:
+                counters = dict(line.split(":") for line in f)
+            sample["read_chars"] = int(counters["rchar"])
+            sample["read_bytes"] = int(counters["read_bytes"])
+        except (OSError, KeyError, ValueError):
+            pass
+        with cls.lock:
+            try:
+                with open("/proc/self/status") as f:
+                    status = dict(line.split(":", 1) for line in f)
+                sample["peak_rss"] = int(status["VmHWM"].split()[0]) * 1024
+                with open("/proc/self/clear_refs", 'w') as f:
+                    f.write("5")  # reset VmHWM to the current RSS
+                cls.peaks.append(sample["peak_rss"])
+            except (OSError, KeyError, ValueError):
+                pass
+            sample["resets"] = len(cls.peaks)
+        return sample
+
+    @classmethod
+    def delta(cls, start, end):
+        """
+        :param start: snapshot at the stage start
+        :param end: snapshot at the stage end
+        :return: stage usage dictionary
+        """
+        usage = {"peak_rss": end["peak_rss"]}
+        if end["resets"] > start["resets"]:  # the end snapshot has reset the mark too, so its peak is in the list
+            usage["peak_rss"] = max(cls.peaks[start["resets"]:end["resets"]])
+        for key in ("wall", "cpu", "read_chars", "read_bytes", "mapped_bytes"):
+            usage[key] = end[key] - start[key] if end[key] is not None else None
+        return usage
+
+    def stage(self, name):
+        """
+        Record usage since the previous stage end or the meter creation
+        :param name: stage name
+        :return: stage usage dictionary with wall and CPU time in seconds, read counters and peak RSS in bytes
+        """
+        end = self.snapshot()
+        self.stages[name] = self.delta(self.mark, end)
+        self.mark = end
+        return self.stages[name]
+
+    def total(self):
+        """
+        Record usage since the meter creation as "total" stage
+        :return: stage usage dictionary
+        """
+        self.stages["total"] = self.delta(self.start, self.snapshot())
+        return self.stages["total"]
+
+
+class CalibrationCancelled(Exception):
+    """
+    Raised inside the calibration pipeline once the user has cancelled the run
+    """
+
+
+def read_tiff_header(name):
+    """
+    Parse the first IFD of a TIFF file. Only tags describing pixel data layout and BlackLevel are decoded
+    :param name: image filename
+    :return: dictionary with byte order ("<" or ">"), image size, BitsPerSample, Compression, SamplesPerPixel,
+    SampleFormat, Orientation, strip offsets and byte counts and blacklevel (None if absent)
+    """
+    with open(name, 'rb') as f:
+        head = f.read(8)
+        if head[:2] not in (b'II', b'MM'):
+            raise ValueError("{} is not a TIFF file".format(name))
+        order = '<' if head[:2] == b'II' else '>'
+        magic, offset = struct.unpack(order + 'HI', head[2:8])
+        if magic != 42:  # BigTIFF and other variants are left to the general reader
+            raise ValueError("{} is not a classic TIFF file".format(name))
+        f.seek(offset)
+        count, = struct.unpack(order + 'H', f.read(2))
+        entries = f.read(12 * count)
+        tags = {}
+        for i in range(count):
+            tag, kind, n = struct.unpack(order + 'HHI', entries[12 * i:12 * i + 8])
+            if tag not in TIFF_TAGS or kind not in TIFF_TYPES:
+                continue
+            fmt = TIFF_TYPES[kind]
+            size = struct.calcsize(fmt) * n
+            data = entries[12 * i + 8:12 * i + 8 + size]
+            if size > 4:  # values which do not fit into the entry are stored at the offset
+                f.seek(struct.unpack(order + 'I', entries[12 * i + 8:12 * i + 12])[0])
+                data = f.read(size)
+            values = struct.unpack(order + fmt[0] * (n * len(fmt)), data)
+            if kind in (5, 10):  # rationals are stored as numerator and denominator pairs
+                values = [values[j] / values[j + 1] for j in range(0, len(values), 2)]
+            tags[TIFF_TAGS[tag]] = list(values)
+    return {
+        "byteorder": order,
+        "width": tags["width"][0],
+        "height": tags["height"][0],
+        "bits": tags.get("bits", [1])[0],
+        "compression": tags.get("compression", [1])[0],
+        "samples": tags.get("samples", [1])[0],
+        "sample_format": tags.get("sample_format", [1])[0],
+        "orientation": tags.get("orientation", [1])[0],
+        "offsets": tags.get("offsets", []),
+        "byte_counts": tags.get("byte_counts", []),
+        "blacklevel": float(tags["blacklevel"][0]) if "blacklevel" in tags else None,
+    }
+
+
+def tiff_view(name, header, data=None):
+    """
+    Map pixel data of an uncompressed single-channel 16-bit TIFF with contiguous strips straight from the file, with no
+    decoding or copying. Orientation tag is applied as a flipped or transposed view, the same way Pillow decodes it
+    :param name: image filename
+    :param header: read_tiff_header result
+    :param data: optional contents of the whole file already read into memory, the view then points into it and is
+    writable if data is a bytearray
+    :return: memory-mapped array of (img_height, img_width) shape or None if the layout is not supported
+    """
+    width, height = header["width"], header["height"]
+    offsets, byte_counts = header["offsets"], header["byte_counts"]
+    if header["compression"] != 1 or header["bits"] != 16 or header["samples"] != 1 or \
+            header["sample_format"] != 1 or not offsets or len(offsets) != len(byte_counts):
+        return None
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i - 1] + byte_counts[i - 1]:
+            return None
+    if sum(byte_counts) < width * height * 2 or header["orientation"] not in TIFF_ORIENTATIONS:
+        return None
+    if data is not None:
+        view = np.frombuffer(data, dtype=header["byteorder"] + 'u2', count=width * height, offset=offsets[0])
+        view = view.reshape(height, width)
+    else:
+        view = np.memmap(name, dtype=header["byteorder"] + 'u2', mode='r', offset=offsets[0], shape=(height, width))
+        UsageMeter.count_mapped(width * height * 2)  # pages are read on first access, callers read whole frames
+    transpose, rows, columns = TIFF_ORIENTATIONS[header["orientation"]]
+    if transpose:
+        view = view.T
+    return view[::rows, ::columns]
+
+
+def read_frame(name):
+    """
+    Read single image as NumPy array of uint16 pixels. Uncompressed TIFF files are memory-mapped, compressed or unusual
+    files are decoded by Pillow
+    :param name: image filename
+    :return: image array of (img_height, img_width) shape
+    """
+    try:
+        view = tiff_view(name, read_tiff_header(name))
+    except (ValueError, KeyError, struct.error):
+        view = None
+    if view is not None:
+        return view
+    with PILImage.open(name) as img:
+        return np.asarray(img)
+
+
+class FrameAccumulator(object):
+    """
+    Streaming per-pixel accumulator of equally sized frames. Frames are added one at a time into a reusable sum buffer,
+    so peak memory stays at a few frames regardless of how many frames are averaged. Integer frames are summed exactly
+    in uint32 (uint64 once the count could overflow it), which gives the same result as np.mean over the whole stack
+
+    Optionally keeps Welford's online mean and sum of squared deviations to provide per-pixel variance (noise map)
+    """
+
+    def __init__(self, variance=False):
+        self.count = 0
+        self.sum = None
+        self.mean = None  # Welford running mean, only kept when variance is enabled
+        self.m2 = None  # Welford sum of squared deviations from the running mean
+        self.track_variance = variance
+
+    def add(self, frame):
+        """
+        Fold frame into the accumulator
+        :param frame: image array of the same shape as previously added frames
+        """
+        if self.sum is None:
+            integer = np.issubdtype(frame.dtype, np.integer) and frame.dtype.itemsize <= 2
+            self.sum = np.zeros(frame.shape, dtype=np.uint32 if integer else np.float64)
+            if self.track_variance:
+                self.mean = np.zeros(frame.shape, dtype=np.float64)
+                self.m2 = np.zeros(frame.shape, dtype=np.float64)
+        elif frame.shape != self.sum.shape:
+            raise ValueError("Frame shape {} differs from {}".format(frame.shape, self.sum.shape))
+        if self.sum.dtype == np.uint32 and self.count >= 2 ** 16:  # next uint16 frame may overflow uint32 sum
+            self.sum = self.sum.astype(np.uint64)
+        np.add(self.sum, frame, out=self.sum, casting="unsafe")
+        self.count += 1
+        if self.track_variance:
+            delta = frame - self.mean
+            self.mean += delta / self.count
+            delta *= frame - self.mean
+            self.m2 += delta
+
+    def average(self):
+        """
+        :return: per-pixel mean of added frames truncated to uint16
+        """
+        if self.count == 0:
+            raise ValueError("no frames averaged")
+        return np.array(self.sum / self.count, dtype='uint16')
+
+    def variance(self):
+        """
+        :return: float64 per-pixel sample variance of added frames (zeros for a single frame)
+        """
+        if not self.track_variance:
+            raise ValueError("Accumulator does not track variance")
+        if self.count == 0:
+            raise ValueError("no frames averaged")
+        return self.m2 / max(self.count - 1, 1)
+
+
+def read_meta(name):
+    """
+    Read tags used for filtering and consistency check from image header. Every image is opened only once, missing
+    tags are stored as None
+    :param name: image filename
+    :return: dictionary with band number (from filename), ISOSpeedRatings, ExposureTime, BandName, image size and
+    blacklevel
+    """
+    img = pyexiv2.Image(name)
+    try:
+        exif = img.read_exif()
+        xmp = img.read_xmp()
+    finally:
+        img.close()
+    try:  # image size and blacklevel are taken from the TIFF header, EXIF is only a fallback for unusual files
+        header = read_tiff_header(name)
+        width, height, blacklevel = header["width"], header["height"], header["blacklevel"]
+    except (ValueError, KeyError, struct.error):
+        width = exif.get('Exif.Image.ImageWidth')
+        height = exif.get('Exif.Image.ImageLength')
+        blacklevel = exif.get('Exif.Image.BlackLevel')
+        blacklevel = float(Fraction(blacklevel)) if blacklevel is not None else None
+    band = re.search(r"img(\d+)_", os.path.basename(name))
+    return {
+        "band": int(band.group(1)) if band else None,
+        "iso": exif.get('Exif.Photo.ISOSpeedRatings'),
+        "exposure": exif.get('Exif.Photo.ExposureTime'),
+        "band_name": xmp.get('Xmp.Camera.BandName'),
+        "width": int(width) if width is not None else None,
+        "height": int(height) if height is not None else None,
+        "blacklevel": blacklevel,
+    }
 
-def meta_filter(img_list):
+
+def build_meta_index(img_list, cache=None, workers=META_WORKERS, progress=None, cancel=None):
+    """
+    Read metadata of all images in one pass and store it as a table keyed by filename. Headers are read on a thread pool
+    since header I/O dominates on network shares. If cache file is given, records of files with unchanged path, size
+    and modification time are taken from it and the table of the current images is written back, so records of removed
+    files are dropped
+    :param img_list: filenames list containing all images from opened directory
+    :param cache: metadata cache filename or None to disable caching
+    :param workers: number of threads reading headers
+    :param progress: optional callable receiving (scanned, total) files count after every header read
+    :param cancel: optional event checked after every header read, CalibrationCancelled is raised once it is set
+    :return: dictionary of read_meta records keyed by filename
+    """
+    cached = {}
+    if cache is not None and os.path.isfile(cache):
+        try:
+            with open(cache) as f:
+                data = json.load(f)
+            if data.get("version") == META_VERSION:
+                cached = data["files"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            cached = {}  # broken or outdated cache is simply rebuilt
+    index = {}
+    entries = {}
+    missing = []
+    for name in img_list:
+        stat = os.stat(name)
+        path = os.path.abspath(name)
+        entry = cached.get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            index[name] = entry["meta"]
+        else:
+            missing.append(name)
+        entries[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "meta": None}
+    if missing:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, meta in zip(missing, pool.map(read_meta, missing)):
+                index[name] = meta
+                if progress is not None:
+                    progress(len(index), len(img_list))
+                if cancel is not None and cancel.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)  # headers not read yet are not waited for
+                    raise CalibrationCancelled()
+    if progress is not None and not missing:
+        progress(len(index), len(img_list))
+    if cache is not None and (missing or entries.keys() != cached.keys()):
+        for name in img_list:
+            entries[os.path.abspath(name)]["meta"] = index[name]
+        try:
+            with open(cache, 'w') as f:
+                json.dump({"version": META_VERSION, "files": entries}, f)
+        except OSError:
+            pass  # directory may be read-only, index is still valid for the current run
+    return index
+
+
+def band_images(img_list, index, band):
+    """
+    :param img_list: filenames list
+    :param index: metadata index built by build_meta_index
+    :param band: band number
+    :return: filenames of the band images in img_list order
+    """
+    return [name for name in img_list if index[name]["band"] == band]
+
+
+def meta_filter(img_list, index):
     """
     Check whether images in img_list contain metadata necessary for image averaging. If they lack tags or the value is 0
     remove those images from the list and display their filenames in the text browser
     :param img_list: filenames list containing all images from opened directory
-    :return: filenames list without filtered images, string with names of removed images
+    :param index: metadata index built by build_meta_index
+    :return: filenames list without filtered images, string with base names of removed images
     """
-    filtered = ""
+    kept = []
+    removed = []
     for name in img_list:
-        img = Image(name)
-        exif = img.read_exif()
-        try:
-            iso_speed = exif['Exif.Photo.ISOSpeedRatings']
-            exposure_time = exif['Exif.Photo.ExposureTime']
-            if iso_speed is None or exposure_time is None or iso_speed == '0' or exposure_time == '0':
-                img_list.remove(name)
-                filtered += str(name) + ", "
-        except KeyError:
-            img_list.remove(name)
-            filtered += str(name) + ", "
-    return img_list, filtered[:len(filtered)-2]
+        iso_speed = index[name]["iso"]
+        exposure_time = index[name]["exposure"]
+        if iso_speed is None or exposure_time is None or iso_speed == '0' or exposure_time == '0':
+            removed.append(os.path.basename(name))
+        else:
+            kept.append(name)
+    return kept, ", ".join(removed)
 
 
-def check_average(img_list):
+def check_bands(img_list, index):
     """
     Check whether the metadata from the image corresponds to the metadata from the first image of each band. BandName is
     used to make sure images are from the same band. ISOSpeedRating and ExposureTime are used to make sure averaging
-    will deliver correct result. If there is a difference in tags, finish function presumably. Else, find an average
-    image and store it in the list. Repeat for each band
+    will deliver correct result. If there is a difference in tags, finish function presumably
     :param img_list: filenames list containing all images from opened directory
-    :return: Checkout flag, average images list, image size parameters and blacklevel
+    :param index: metadata index built by build_meta_index
+    :return: Checkout flag, list of band filenames lists, image size parameters and blacklevel (None if the check
+    failed)
     """
-    averages = []
+    bands = []
     for i in range(5):
-        # Filter out all filenames but from band that is being processed
-        names = [name for name in img_list if "img{}_".format(i) in name]
-        img = Image(names[0])  # read first image and use its metadata as a reference
-        exif = img.read_exif()
-        xmp = img.read_xmp()
-        iso_speed = exif['Exif.Photo.ISOSpeedRatings']
-        exposure_time = exif['Exif.Photo.ExposureTime']
-        band_name = xmp['Xmp.Camera.BandName']
+        names = band_images(img_list, index, i)  # filter out all filenames but from band that is being processed
+        reference = index[names[0]]  # use metadata of the first image as a reference
         # Also define image size parameters and blacklevel from metadata for further use in the main script
-        img_width = int(exif['Exif.Image.ImageWidth'])
-        img_height = int(exif['Exif.Image.ImageLength'])
-        blacklevel = float(exif['Exif.Image.BlackLevel'][:len(exif['Exif.Image.BlackLevel'])-2])
-        for j in range(1, len(names)):  # compare metadata from each image (besides first) to the reference
-            img = Image(names[j])
-            exif = img.read_exif()
-            xmp = img.read_xmp()
-            if exif['Exif.Photo.ISOSpeedRatings'] != iso_speed or exif['Exif.Photo.ExposureTime'] != exposure_time or \
-                    xmp['Xmp.Camera.BandName'] != band_name:
-                return False, averages
-
-        # Open images as NumPy arrays of arrays for successful averaging of uint16 pixels
-        images = np.array([np.array(mpimg.imread(name)) for name in names])
-        average = np.array(np.mean(images, axis=0), dtype='uint16')
-        averages.append(average)
-    return True, averages, img_width, img_height, blacklevel
+        img_width = reference["width"]
+        img_height = reference["height"]
+        blacklevel = reference["blacklevel"]
+        for name in names[1:]:  # compare metadata from each image (besides first) to the reference
+            meta = index[name]
+            if meta["iso"] != reference["iso"] or meta["exposure"] != reference["exposure"] or \
+                    meta["band_name"] != reference["band_name"]:
+                return False, bands, None, None, None
+        bands.append(names)
+    return True, bands, img_width, img_height, blacklevel
+
+
+def average_frames(names, noise=False, progress=None, cancel=None):
+    """
+    Find an average image of the band. Frames are streamed through the accumulator one by one, so memory does not
+    depend on frames count
+    :param names: filenames of the band images
+    :param noise: whether per-pixel variance map should be computed as well
+    :param progress: optional callable receiving (averaged, total) frames count after every frame
+    :param cancel: optional event checked before every frame, CalibrationCancelled is raised once it is set
+    :return: uint16 average image, variance map or None
+    """
+    accumulator = FrameAccumulator(variance=noise)
+    for name in names:
+        if cancel is not None and cancel.is_set():
+            raise CalibrationCancelled()
+        accumulator.add(read_frame(name))
+        if progress is not None:
+            progress(accumulator.count, len(names))
+    return accumulator.average(), accumulator.variance() if noise else None
+
+
+def masked_median(data):
+    """
+    Median along the first axis ignoring NaN values, vectorized over all pixels unlike np.nanmedian, which falls back
+    to a per-pixel loop on large arrays
+    :param data: float array of (frames, ...) shape with NaN in place of rejected values, at least one value of every
+    pixel must be present
+    :return: median array of data.shape[1:] shape
+    """
+    ordered = np.sort(data, axis=0)  # NaN values are sorted last
+    count = np.count_nonzero(~np.isnan(data), axis=0)
+    low = np.take_along_axis(ordered, ((count - 1) // 2)[np.newaxis], axis=0)[0]
+    high = np.take_along_axis(ordered, (count // 2)[np.newaxis], axis=0)[0]
+    return (low + high) / 2
+
+
+def clip_tile(views, start, stop, sigma=CLIP_SIGMA, iterations=CLIP_ITERATIONS):
+    """
+    Sigma-clipped mean of rows [start, stop) of the frame stack. Every pass rejects values further than sigma
+    deviations from the median of the values kept by the previous pass, until nothing changes. The first pass takes
+    the robust deviation (1.4826 median absolute deviations), so a single outlier does not hide itself by inflating it,
+    later passes take the standard deviation of kept values, which is less noisy for a few frames and lets wrongly
+    rejected values back
+    :param views: frame arrays of the same (img_height, img_width) shape, usually memory-mapped
+    :param start: first row of the tile
+    :param stop: row after the last row of the tile
+    :param sigma: rejection threshold in deviations
+    :param iterations: largest number of passes
+    :return: float64 mean of kept values of (stop - start, img_width) shape, rejected values count of every frame
+    """
+    stack = np.empty((len(views), stop - start, views[0].shape[1]), dtype=np.float32)  # uint16 values are exact
+    for i, view in enumerate(views):
+        stack[i] = view[start:stop]
+    kept = None
+    for _ in range(iterations):
+        if kept is None:
+            center = masked_median(stack)
+            spread = 1.4826 * masked_median(np.abs(stack - center))
+        else:
+            center = masked_median(np.where(kept, stack, np.nan))
+            deviation = np.where(kept, stack - center, 0)  # small values, float32 sums of squares stay precise
+            count = np.count_nonzero(kept, axis=0)
+            spread = np.sqrt(np.maximum(np.sum(deviation * deviation, axis=0) / count -
+                                        (np.sum(deviation, axis=0) / count) ** 2, 0))
+        np.maximum(spread, CLIP_FLOOR, out=spread)
+        clipped = np.abs(stack - center) <= sigma * spread
+        if kept is not None and np.array_equal(clipped, kept):
+            break
+        kept = clipped
+    total = np.sum(np.where(kept, stack, 0), axis=0, dtype=np.float64)
+    return total / np.count_nonzero(kept, axis=0), np.count_nonzero(~kept, axis=(1, 2))
+
+
+def clipped_average(names, sigma=CLIP_SIGMA, iterations=CLIP_ITERATIONS, workers=TILE_WORKERS, progress=None,
+                    cancel=None):
+    """
+    Find a robust average image of the band: frames are split into tiles of rows and every tile of the frame stack is
+    sigma-clipped by clip_tile in a thread pool. Tile height is chosen so that every tile fits into CLIP_TILE and frames
+    are memory-mapped, so memory stays bounded by the number of threads for hundreds of frames. Compressed frames are
+    decoded into memory once
+    :param names: filenames of the band images
+    :param sigma: rejection threshold in robust deviations
+    :param iterations: largest number of clipping passes
+    :param workers: number of threads, None to use all CPU cores
+    :param progress: optional callable receiving (averaged, total) frames count, frames are counted in proportion to
+    clipped rows
+    :param cancel: optional event checked between tiles, CalibrationCancelled is raised once it is set
+    :return: uint16 average image, float64 fraction of rejected pixels of every frame
+    """
+    views = [read_frame(name) for name in names]
+    height, width = views[0].shape
+    for name, view in zip(names, views):
+        if view.shape != (height, width):
+            raise ValueError("Frame shape {} of {} differs from {}".format(view.shape, name, (height, width)))
+    workers = workers or os.cpu_count() or 1
+    # stack copy, masked copy, sorted copy and deviations are alive at once, 4 bytes per value
+    rows = max(1, min(height, CLIP_TILE // (4 * 4 * len(views) * width)))
+    tiles = [(start, min(start + rows, height)) for start in range(0, height, rows)]
+    average = np.empty((height, width), dtype=np.float64)
+    rejected = np.zeros(len(views), dtype=np.int64)
+    done = 0
+    with ThreadPoolExecutor(max_workers=min(workers, len(tiles))) as pool:
+        futures = {pool.submit(clip_tile, views, start, stop, sigma, iterations): (start, stop)
+                   for start, stop in tiles}
+        for future in as_completed(futures):
+            if cancel is not None and cancel.is_set():
+                for pending in futures:
+                    pending.cancel()
+                raise CalibrationCancelled()
+            start, stop = futures[future]
+            average[start:stop], counts = future.result()
+            rejected += counts
+            done += stop - start
+            if progress is not None:
+                progress(len(names) * done // height, len(names))
+    return np.array(average, dtype='uint16'), rejected / (height * width)
+
+
+def incremental_average(band, names, reference, progress=None, cancel=None):
+    """
+    Find an average image of the band reusing the averaging state (running sum, frames count, reference metadata and
+    images list) saved next to the images by the previous run. Only images missing from the state are read and folded
+    in, then the updated state is saved back. The state is dropped if its reference metadata differs or any of its
+    images was removed or modified since
+    :param band: band number, used in the state filename
+    :param names: filenames of the band images
+    :param reference: metadata index record of the first band image
+    :param progress: optional callable receiving (averaged, total) frames count after every frame
+    :param cancel: optional event checked before every frame, CalibrationCancelled is raised once it is set
+    :return: uint16 average image, number of frames taken from the saved state
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(names[0])), STATE_FILE.format(band))
+    files = {}
+    for name in names:
+        stat = os.stat(name)
+        files[os.path.basename(name)] = [stat.st_size, stat.st_mtime_ns]
+    accumulator = FrameAccumulator()
+    saved = {}
+    try:
+        with np.load(path) as data:
+            state_files = json.loads(str(data["files"]))
+            if json.loads(str(data["reference"])) == reference and \
+                    all(files.get(name) == stat for name, stat in state_files.items()):
+                accumulator.sum = data["sum"]
+                accumulator.count = int(data["count"])
+                saved = state_files
+    except (OSError, ValueError, KeyError):
+        pass  # no state or a broken one, all images are averaged
+    reused = accumulator.count
+    for name in names:
+        if os.path.basename(name) in saved:
+            continue
+        if cancel is not None and cancel.is_set():
+            raise CalibrationCancelled()
+        accumulator.add(read_frame(name))
+        if progress is not None:
+            progress(accumulator.count, len(names))
+    if accumulator.count > reused:
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp, 'wb') as f:
+                np.savez(f, sum=accumulator.sum, count=accumulator.count, files=json.dumps(files),
+                         reference=json.dumps(reference))
+            os.replace(temp, path)
+        except OSError:
+            pass  # read-only directory, the next run just averages everything again
+    elif progress is not None:
+        progress(accumulator.count, len(names))
+    return accumulator.average(), reused
+
+
+@lru_cache(maxsize=8)
+def radius_grid(img_width, img_height, xc, yc):
+    """
+    Compute distance from every pixel to the vignette center. Bands often share the same center, so the grid is cached
+    and reused instead of being recomputed for every band
+    :param img_width: image width in pixels
+    :param img_height: image height in pixels
+    :param xc: vignette center x coordinate
+    :param yc: vignette center y coordinate
+    :return: read-only float64 array of (img_width, img_height) shape with radius to every pixel
+    """
+    x = np.arange(img_width, dtype=np.float64) - xc
+    y = np.arange(img_height, dtype=np.float64) - yc
+    grid = np.sqrt(x[:, None] ** 2 + y[None, :] ** 2)
+    grid.flags.writeable = False  # grid is shared between calls, protect it from accidental modification
+    return grid
+
+
+def radial_profile(image, xc, yc):
+    """
+    Normalize every pixel of the image to the brightest pixel value (11x11 mean around the vignette center) and pair it
+    with its distance to the center. Pixels brighter than 1.2 of the reference are considered outliers and dropped
+    :param image: transposed averaged image of (img_width, img_height) shape with subtracted blacklevel
+    :param xc: vignette center x coordinate, may be sub-pixel
+    :param yc: vignette center y coordinate, may be sub-pixel
+    :return: float64 arrays of radii and normalized pixel values in pixel order
+    """
+    x0, y0 = int(round(xc)), int(round(yc))
+    Vref = image[x0-5:x0+6, y0-5:y0+6].mean()
+    V = image / Vref
+    mask = V < 1.2
+    r = radius_grid(image.shape[0], image.shape[1], xc, yc)
+    return r[mask], V[mask]
 
 
 def poly6(x, b, c, e, g):
     return 1 + b * x + c * x**2 + e * x**4 + g * x**6
 
 
-class Ui_MainWindow(object):
-    """
-    Qt-generated GUI Class with implemented open_file, finder and save_file functions. Open directory with
-    images of Geoscan Pollux bands. Launch the main script to calculate vignette coefficients and store them into lists.
-    Save tags.json and tags.ini configuration files in chosen directory
-
-    The GUI contains text browser to inform the user about the calibration progress
-    """
-
-    def setupUi(self, MainWindow):
-        MainWindow.setObjectName("MainWindow")
-        MainWindow.setFixedSize(543, 408)
-        self.centralwidget = QtWidgets.QWidget(MainWindow)
-        self.centralwidget.setObjectName("centralwidget")
-        self.label = QtWidgets.QLabel(self.centralwidget)
-        self.label.setGeometry(QtCore.QRect(0, 20, 540, 50))
-        font = QtGui.QFont()
-        font.setFamily("Ubuntu Mono")
-        font.setPointSize(16)
-        font.setBold(True)
-        font.setWeight(75)
-        self.label.setFont(font)
-        self.label.setStyleSheet("")
-        self.label.setAlignment(QtCore.Qt.AlignCenter)
-        self.label.setObjectName("label")
-        self.text = QtWidgets.QTextBrowser(self.centralwidget)
-        self.text.setGeometry(QtCore.QRect(15, 65, 520, 300))
-        self.text.setStyleSheet("")
-        self.text.setObjectName("text")
-        self.btn_start = QtWidgets.QPushButton(self.centralwidget)
-        self.btn_start.setEnabled(False)
-        self.btn_start.setGeometry(QtCore.QRect(15, 370, 150, 30))
-        self.btn_start.setObjectName("btn_start")
-        self.btn_clear = QtWidgets.QPushButton(self.centralwidget)
-        self.btn_clear.setGeometry(QtCore.QRect(425, 370, 110, 30))
-        self.btn_clear.setObjectName("btn_clear")
-        self.line = QtWidgets.QFrame(self.centralwidget)
-        self.line.setGeometry(QtCore.QRect(0, 10, 543, 30))
-        self.line.setFrameShape(QtWidgets.QFrame.HLine)
-        self.line.setFrameShadow(QtWidgets.QFrame.Sunken)
-        self.line.setObjectName("line")
-        self.btn_open = QtWidgets.QPushButton(self.centralwidget)
-        self.btn_open.setGeometry(QtCore.QRect(0, 0, 80, 25))
-        self.btn_open.setAutoFillBackground(False)
-        self.btn_open.setStyleSheet("")
-        self.btn_open.setObjectName("btn_open")
-        self.btn_save = QtWidgets.QPushButton(self.centralwidget)
-        self.btn_save.setEnabled(False)
-        self.btn_save.setGeometry(QtCore.QRect(80, 0, 90, 25))
-        self.btn_save.setObjectName("btn_save")
-        MainWindow.setCentralWidget(self.centralwidget)
-        self.retranslateUi(MainWindow)
-        QtCore.QMetaObject.connectSlotsByName(MainWindow)
-
-    def retranslateUi(self, MainWindow):
-        _translate = QtCore.QCoreApplication.translate
-        MainWindow.setWindowTitle(_translate("MainWindow", "Vignette Finder"))
-        self.label.setText(_translate("MainWindow", "Определение параметров виньетирования"))
-        self.text.setHtml(_translate("MainWindow", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
-"<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
-"p, li { white-space: pre-wrap; }\n"
-"</style></head><body style=\" font-family:\'Ubuntu\'; font-size:11pt; font-weight:400; font-style:normal;\">\n"
-"<p style=\" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><span style=\" color:#000000;\">"
-                                                   "Чтобы начать, откройте директорию с фотографиями</span></p></body></html>"))
-        self.btn_open.setText(_translate("MainWindow", "Открыть"))
-        self.btn_open.clicked.connect(self.open_file)
-        self.btn_start.setText(_translate("MainWindow", "Запустить скрипт"))
-        self.btn_start.clicked.connect(self.finder)
-        self.btn_clear.setText(_translate("MainWindow", "Очистить"))
-        self.btn_clear.clicked.connect(self.text.clear)
-        self.btn_save.setText(_translate("MainWindow", "Сохранить"))
-        self.btn_save.clicked.connect(self.save_file)
-
-    def open_file(self):
-        """
-        Change current directory to the folder of user's choice for further use by the main script. Display selected
-        directory in the text browser
-        """
-        folder = QtWidgets.QFileDialog.getExistingDirectory(None, "Выберите директорию")
-        if folder:
-            self.text.append("Открыта директория {}".format(folder))
-            self.btn_start.setEnabled(True)  # enable "Запустить скрипт" button to work with inner images
-            os.chdir(folder)
-            QtWidgets.qApp.processEvents()
-
-    def finder(self):
-        """
-        Open all filtered images in chosen directory and store them in the list. If there are images in correct format,
-        launch check_average and use returned images list to calculate the vignette centers (theorized to correlate
-        with mass center of the image) and vignette coefficients as polynomial of pixels brightness approximation.
-        Format and store collected data in lists as strings. Check if coefficients exceed proposed limits and display
-        warnings in the text browser
-        """
-        allfiles = os.listdir(os.getcwd())  # get all filenames in the current directory
-        # Filter out everything but "img...tif" files and sort them by names
-        img_list = [filename for filename in allfiles if filename.startswith("img") and filename.endswith(".tif")]
-        img_list.sort()
-        if len(img_list) == 0:
-            self.text.append("Фотографии в директории отсутствуют")
-            pass
+def bin_profile(r, V):
+    """
+    Group radial profile samples by integer radius. Every bin keeps mean radius, mean value and samples count, so a few
+    thousand bins stand for more than a million pixels in the approximation
+    :param r: radii of the profile samples
+    :param V: normalized pixel values of the profile samples
+    :return: arrays of non-empty bins mean radius, mean value and samples count
+    """
+    idx = r.astype(np.intp)
+    count = np.bincount(idx)
+    r_mean = np.bincount(idx, weights=r)
+    V_mean = np.bincount(idx, weights=V)
+    keep = count > 0
+    r_mean[keep] /= count[keep]
+    V_mean[keep] /= count[keep]
+    return r_mean[keep], V_mean[keep], count[keep]
+
+
+def fit_poly6(r, V, mode=FIT_MODE):
+    """
+    Approximate radial profile with poly6. In "binned" mode samples are binned by radius and coefficients are found
+    by closed-form weighted least squares over the bins (poly6 is linear in its coefficients). Radius is normalized to
+    [0, 1] to keep the system well conditioned. In "curve_fit" mode every sample is passed to the iterative
+    Levenberg-Marquardt fit, which is slower but serves as a reference
+    :param r: radii of the profile samples
+    :param V: normalized pixel values of the profile samples
+    :param mode: one of FIT_MODES
+    :return: poly6 coefficients b, c, e, g
+    """
+    if mode == "curve_fit":
+        popt, pcov = optimize.curve_fit(poly6, r, V)
+        return popt
+    if mode != "binned":
+        raise ValueError("Unknown fit mode {}".format(mode))
+    r_bin, V_bin, count = bin_profile(r, V)
+    scale = r_bin.max()
+    s = r_bin / scale
+    powers = np.array([1, 2, 4, 6])
+    weights = np.sqrt(count)  # bin mean of n samples stands for n equations of the full pixel set
+    A = s[:, None] ** powers * weights[:, None]
+    coef = np.linalg.lstsq(A, (V_bin - 1) * weights, rcond=None)[0]
+    return coef / scale ** powers
+
+
+def fit_center(image, xc, yc, factor=PYRAMID_FACTOR):
+    """
+    Coarse stage of the vignette center search. The image is downsampled by factor x factor block means and sub-pixel
+    center is fitted jointly with brightness scale and poly6 coefficients by nonlinear least squares, starting from the
+    given center and the binned fit around it. Coordinates and radius are normalized by the image diagonal to keep all
+    parameters of the same order
+    :param image: transposed averaged image of (img_width, img_height) shape with subtracted blacklevel
+    :param xc: initial vignette center x coordinate, e.g. center of mass
+    :param yc: initial vignette center y coordinate
+    :param factor: downsampling factor
+    :return: sub-pixel vignette center x and y coordinates, the initial ones if the fit diverged
+    """
+    width = image.shape[0] // factor * factor
+    height = image.shape[1] // factor * factor
+    small = image[:width, :height].reshape(width // factor, factor, height // factor, factor).mean(axis=(1, 3))
+    x = np.arange(width // factor) * factor + (factor - 1) / 2  # block centers in full resolution pixels
+    y = np.arange(height // factor) * factor + (factor - 1) / 2
+    x0, y0 = int(round(xc)), int(round(yc))
+    V = small / image[x0-5:x0+6, y0-5:y0+6].mean()  # the same normalization as in radial_profile
+    mask = V < 1.2
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    X, Y, V = X[mask], Y[mask], V[mask]
+    scale = float(np.hypot(*image.shape))
+    popt = fit_poly6(np.hypot(X - xc, Y - yc), V)
+    p0 = np.concatenate(([xc / scale, yc / scale, 1.0], popt * scale ** np.array([1, 2, 4, 6])))
+    X /= scale
+    Y /= scale
+
+    def residuals(p):
+        s = np.hypot(X - p[0], Y - p[1])
+        return p[2] * poly6(s, *p[3:]) - V
+    result = optimize.least_squares(residuals, p0, method='lm')
+    x, y = result.x[0] * scale, result.x[1] * scale
+    if not result.success or not (0 <= x < image.shape[0] and 0 <= y < image.shape[1]):
+        return xc, yc  # the fit diverged, keep the initial center
+    return x, y
+
+
+def fit_deviation(popt, ref, r_max):
+    """
+    Measure how far poly6 coefficients are from the reference ones. Coefficients of even polynomial powers are strongly
+    correlated, so the difference of approximated curves is reported along with the coefficients difference
+    :param popt: poly6 coefficients b, c, e, g to check
+    :param ref: reference poly6 coefficients b, c, e, g
+    :param r_max: largest radius of the approximated profile
+    :return: largest relative coefficient difference, largest absolute curve difference on [0, r_max]
+    """
+    popt = np.asarray(popt, dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    coef_diff = np.max(np.abs(popt - ref) / np.abs(ref))
+    x = np.linspace(0, r_max, 1024)
+    curve_diff = np.max(np.abs(poly6(x, *popt) - poly6(x, *ref)))
+    return coef_diff, curve_diff
+
+
+def format_coefficients(popt):
+    """
+    Format poly6 coefficients as six polynomial coefficients (zeros for absent r^3 and r^5 terms) and check whether they
+    exceed proposed limits
+    :param popt: poly6 coefficients b, c, e, g
+    :return: list of six coefficients, "1.1;2.2;0;4.4;0;6.6" string, indices of limit-exceeding coefficients
+    """
+    checks = str(popt)[1:-1].split()  # format coefficients for check and further usage
+    checks.insert(2, "0")
+    checks.insert(4, "0")
+    checks = list(map(float, checks))
+    coefficient = ";".join(str(check) for check in checks).replace("0.0;", "0;")
+    err_arr = []  # list to store limit-exceeding coefficients
+    if checks[0] < -10e-05 or checks[0] > 10e-05:
+        err_arr.append(0)
+    if checks[1] < -10e-07 or checks[1] > 10e-07:
+        err_arr.append(1)
+    if checks[3] < -10e-13 or checks[3] > 10e-13:
+        err_arr.append(3)
+    if checks[5] < -10e-19 or checks[5] > 10e-19:
+        err_arr.append(5)
+    return checks, coefficient, err_arr
+
+
+def calibrate_band(band, names, blacklevel, fit_mode=FIT_MODE, progress=None, cancel=None, cache=None,
+                   reference=None, center_mode=CENTER_MODE, average_mode=AVERAGE_MODE, frames_key=None,
+                   tile_workers=TILE_WORKERS):
+    """
+    Calibrate single band: average its images, find the vignette center (theorized to correlate with mass center of
+    the image) and approximate pixels brightness with poly6. In "joint" center mode the center of mass is only a
+    starting point: sub-pixel center is fitted together with the polynomial on the downsampled image by fit_center, then
+    the polynomial is refined on the full resolution radial profile. In "clipped" average mode frames are averaged by
+    clipped_average, which rejects shadows, flicker and hotspots of single frames, and frames with mostly rejected
+    pixels are reported. Bands are independent, so the function is run in a separate process for each band
+    :param band: band number, used in progress reports
+    :param names: filenames of the band images
+    :param blacklevel: blacklevel to subtract from the average image
+    :param fit_mode: one of FIT_MODES
+    :param progress: optional callable receiving ("average", band, averaged, total) after every frame and
+    ("fit", band, 1, 1) once the band is approximated
+    :param cancel: optional event checked between frames and stages, CalibrationCancelled is raised once it is set
+    :param cache: optional ResultCache to take the averaged image from and to store the average and the result into
+    :param reference: metadata index record of the first band image, if given the average is found incrementally with
+    incremental_average. Running sums cannot be clipped, so the state is not used in "clipped" average mode
+    :param center_mode: one of CENTER_MODES
+    :param average_mode: one of AVERAGE_MODES
+    :param frames_key: cache key of the frame set if the caller has already found it, hashing frames is not free
+    :param tile_workers: threads of clipped_average, None to use all CPU cores
+    :return: dictionary with vignette center coordinates and "x;y" string, six coefficients, "1.1;2.2;0;4.4;0;6.6"
+    string, indices of limit-exceeding coefficients, deviation of the fast fit for the reference fit mode, number of
+    frames reused from the saved averaging state, rejected pixels fractions of frames exceeding REJECT_LIMIT by
+    filename, stage timings in seconds and UsageMeter stages of the band
+    """
+    report = None
+    if progress is not None:
+        def report(done, total):
+            progress(("average", band, done, total))
+    timings = {}
+    meter = UsageMeter()
+    cached = None
+    reused = 0
+    rejected = None
+    if cache is not None:
+        if frames_key is None:
+            frames_key = cache.frames_key(names, average_mode)
+        cached = cache.load_average(frames_key)
+    if cached is None:
+        if average_mode == "clipped":
+            average, rejected = clipped_average(names, workers=tile_workers, progress=report, cancel=cancel)
+        elif reference is not None:
+            average, reused = incremental_average(band, names, reference, report, cancel)
         else:
-            note = "Найдены следующие изображения: "
-            for img in img_list:  # display found images in the text browser
-                note += "{}, ".format(img)
-            note = note[:len(note)-2]
-            self.text.append(note)
-            QtWidgets.qApp.processEvents()
-            img_list, filtered = meta_filter(img_list)
-            note = "Следующие изображения не содержат необходимые теги и будут проигнорированы: {}".format(filtered)
-            self.text.append(note)
-            QtWidgets.qApp.processEvents()
-            meta_check, avg_arr, img_width, img_height, blacklevel = check_average(img_list)
-            if meta_check:
-                self.text.append("Метаданные изображений совпадают, поиск параметров...")
-                QtWidgets.qApp.processEvents()
-                for i in range(5):
-                    # Calculating vignette center position which is supposed to be the brightest point in the image
-                    note = ("Центр виньетирования для канала {}: ".format(i))
-                    image = avg_arr[i].T
-                    image = image - blacklevel
-                    com = ndimage.center_of_mass(image)  # center of mass calculation method
-                    xc = int(com[0])
-                    yc = int(com[1])
-                    center = str(xc)+";"+str(yc)
-                    centers.append(center)
-                    note += str(xc)+", "+str(yc)
-                    self.text.append(note)
-                    QtWidgets.qApp.processEvents()
-
-                    note = "Коэффициенты полинома: "
-                    # Calculating brightest pixel value. All images will be normalized to that value. Averaging 11x11
-                    Vref = image[xc-5:xc+6, yc-5:yc+6].mean()
-                    Vx = np.empty(img_width)
-                    df_r = []
-                    df_V = []
-                    j = 0
-                    k = 0
-                    """ Following cycle computes each pixel to brighest pixel ratio, distance to vignetting center 
-                    and stores data in the lists to be used in the save_file function later """
-                    while j < img_width:
-                        while k < img_height:
-                            Vx[j] = image[j, k] / Vref
-                            if Vx[j] < 1.2:
-                                r = ((j - xc) ** 2 + (k - yc) ** 2) ** (1 / 2)
-                                df_r.append(r)  # append radius to the processed pixel into dataframe
-                                # append processed pixel value normalized to the brightest pixel value into dataframe
-                                df_V.append(str(Vx[j]))
-                            k = k + 1
-                        k = 0
-                        j = j + 1
-                    df0 = np.vstack((df_r, df_V)).T
-                    df0 = df0.astype(np.float64)
-                    df0 = pd.DataFrame(df0, columns=['r', 'V'])  # form a dataframe for approximation
-                    popt, pcov = curve_fit(poly6, df0['r'], df0['V'])  # coefficients calculation using polynomial
-
-                    err_arr = []  # list to store limit-exceeding coefficients
-                    checks = str(popt)[1:-1].split()  # format coefficients for check and further usage
-                    checks.insert(2, "0")
-                    checks.insert(4, "0")
-                    checks = list(map(float, checks))
-                    note += str(checks)
-                    coefficient = ""
-                    for j in range(len(checks)):
-                        coefficient += str(checks[j])+";"
-                    coefficient = coefficient[:len(coefficient)-1]
-                    coefficient = coefficient.replace("0.0;", "0;")
-                    coefficients.append(coefficient)  # append formatted coefficients into err_arr
-                    if checks[0] < -10e-05 or checks[0] > 10e-05:
-                        err_arr.append(0)
-                    if checks[1] < -10e-07 or checks[1] > 10e-07:
-                        err_arr.append(1)
-                    if checks[3] < -10e-13 or checks[3] > 10e-13:
-                        err_arr.append(3)
-                    if checks[5] < -10e-19 or checks[5] > 10e-19:
-                        err_arr.append(5)
-                    note = note.replace("'", "")
-                    note = note.replace("[", "")
-                    note = note.replace("]", "")
-                    if len(err_arr) != 0:  # if limits are exceeded, display exceeding coefficient
-                        note += "; потенциально некачественные: "
-                        for err in err_arr:
-                            note += str(checks[err]) + ", "
-                        note = note[:len(note)-2]
-                    self.text.append(note)
-                    QtWidgets.qApp.processEvents()
-
-                self.text.append("Скрипт завершен, сохраните файлы конфигурации")
-                QtWidgets.qApp.processEvents()
-                self.btn_save.setEnabled(True)  # enable "Сохранить" button
+            average, _ = average_frames(names, progress=report, cancel=cancel)
+        if cache is not None:
+            cache.store_average(frames_key, average, names, rejected)
+    else:
+        average, rejected = cached
+        if report is not None:
+            report(len(names), len(names))
+    timings["average"] = meter.stage("average")["wall"]
+    if cancel is not None and cancel.is_set():
+        raise CalibrationCancelled()
+    image = average.T - blacklevel
+    com = ndimage.center_of_mass(image)  # center of mass calculation method
+    if center_mode == "joint":
+        xc, yc = fit_center(image, com[0], com[1])
+        center = "{:.2f};{:.2f}".format(xc, yc)
+    else:
+        xc = int(com[0])
+        yc = int(com[1])
+        center = str(xc) + ";" + str(yc)
+    timings["center"] = meter.stage("center")["wall"]
+    if cancel is not None and cancel.is_set():
+        raise CalibrationCancelled()
+    # Each pixel is normalized to the brightest pixel value and paired with its distance to the center
+    r, V = radial_profile(image, xc, yc)
+    timings["profile"] = meter.stage("profile")["wall"]
+    if cancel is not None and cancel.is_set():
+        raise CalibrationCancelled()
+    popt = fit_poly6(r, V, fit_mode)  # coefficients calculation using polynomial
+    deviation = None
+    if fit_mode == "curve_fit":  # compare fast fit against the reference one
+        deviation = fit_deviation(fit_poly6(r, V, "binned"), popt, r.max())
+    timings["fit"] = meter.stage("fit")["wall"]
+    meter.total()
+    checks, coefficient, err_arr = format_coefficients(popt)
+    if progress is not None:
+        progress(("fit", band, 1, 1))
+    result = {
+        "xc": xc,
+        "yc": yc,
+        "center": center,
+        "checks": checks,
+        "coefficient": coefficient,
+        "errors": err_arr,
+        "deviation": deviation,
+        "reused_frames": reused,
+        "rejected": {} if rejected is None else {os.path.basename(name): float(fraction)
+                                                 for name, fraction in zip(names, rejected)
+                                                 if fraction > REJECT_LIMIT},
+        "timings": timings,
+        "usage": meter.stages,
+    }
+    if cache is not None:
+        cache.store_result(cache.result_key(frames_key, blacklevel, fit_mode, center_mode), result, names)
+    return result
+
+
+class ResultCache(object):
+    """
+    Persistent on-disk cache of per-band calibration outputs. Averaged frames are stored under a key of the frame set
+    identity (paths, sizes and modification times, or content hashes), results under that key combined with blacklevel
+    and fit parameters. Unchanged captures are never recalibrated, and a refit with other settings reuses the averaged
+    frames without any image I/O
+
+    Keys are SHA-256 digests, so the cache may be shared by several processes. Entries are touched on every hit and the
+    least recently used ones are evicted once the cache grows over its size limit
+    """
+
+    def __init__(self, folder=CACHE_DIR, max_size=CACHE_SIZE, content_hash=False):
+        self.folder = folder
+        self.max_size = max_size
+        self.content_hash = content_hash
+
+    def frames_key(self, names, average_mode=AVERAGE_MODE):
+        """
+        :param names: filenames of the band images
+        :param average_mode: one of AVERAGE_MODES, averages of different modes are cached separately
+        :return: key of the frame set
+        """
+        identity = []
+        for name in names:
+            path = os.path.abspath(name)
+            if self.content_hash:
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(chunk)
+                identity.append((path, digest.hexdigest()))
             else:
-                self.text.append("Обнаружены несовпадения в метаданных изображений")
-                QtWidgets.qApp.processEvents()
-
-    def save_file(self):
-        """
-        Change current directory to the folder of user's choice. Get vignette parameters from centers and coefficients
-        lists and format them into .json and .ini files templates. Save files into the selected directory
-        """
-        folder = QtWidgets.QFileDialog.getExistingDirectory(None, "Выберите директорию")
-        if folder:
-            os.chdir(folder)
-            params = (centers[0], coefficients[0], centers[1], coefficients[1], centers[2], coefficients[2], centers[3],
-                      coefficients[3], centers[4], coefficients[4])
-            json_string = '''
-                        {
-                                "Cams": {
-                                    "0": {
-                                        "central_wavelength": "470",
-                                        "band_name": "Blue",
-                                        "wavelength_fwhm": "28",
-                                        "fnumber": "1.8",
-                                        "band_sensitivity": "0.83",
-                                        "vignetting_center": "%s",
-                                        "vignetting_polynomial": "%s",
-                                        "radiometric_calibration": "0.000119266;0"
-                                    },
-                                    "1": {
-                                        "central_wavelength": "560",
-                                        "band_name": "Green",
-                                        "wavelength_fwhm": "20",
-                                        "fnumber": "1.8",
-                                        "band_sensitivity": "0.8",
-                                        "vignetting_center": "%s",
-                                        "vignetting_polynomial": "%s",
-                                        "radiometric_calibration": "0.000123596;0"
-                                    },
-                                    "2": {
-                                        "central_wavelength": "665",
-                                        "band_name": "Red",
-                                        "wavelength_fwhm": "14",
-                                        "fnumber": "1.8",
-                                        "band_sensitivity": "0.4",
-                                        "vignetting_center": "%s",
-                                        "vignetting_polynomial": "%s",
-                                        "radiometric_calibration": "0.000246559;0"
-                                    },
-                                    "3": {
-                                        "central_wavelength": "720",
-                                        "band_name": "Rededge",
-                                        "wavelength_fwhm": "12",
-                                        "fnumber": "1.8",
-                                        "band_sensitivity": "0.307",
-                                        "vignetting_center": "%s",
-                                        "vignetting_polynomial": "%s",
-                                        "radiometric_calibration": "0.000322352;0"
-                                    },
-                                    "4": {
-                                        "central_wavelength": "840",
-                                        "band_name": "NIR",
-                                        "wavelength_fwhm": "40",
-                                        "fnumber": "1.8",
-                                        "band_sensitivity": "0.73",
-                                        "vignetting_center": "%s",
-                                        "vignetting_polynomial": "%s",
-                                        "radiometric_calibration": "0.000135683;0"
-                                    }
-                                }
+                stat = os.stat(path)
+                identity.append((path, stat.st_size, stat.st_mtime_ns))
+        return self.digest({"version": CACHE_VERSION, "frames": identity, "average_mode": average_mode})
+
+    def result_key(self, frames_key, blacklevel, fit_mode, center_mode):
+        """
+        :param frames_key: key of the frame set
+        :param blacklevel: blacklevel subtracted from the average image
+        :param fit_mode: one of FIT_MODES
+        :param center_mode: one of CENTER_MODES
+        :return: key of the band calibration result
+        """
+        return self.digest({"version": CACHE_VERSION, "frames": frames_key, "blacklevel": blacklevel,
+                            "fit_mode": fit_mode, "center_mode": center_mode})
+
+    @staticmethod
+    def digest(value):
+        return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.folder, key + extension)
+
+    def load_average(self, key):
+        """
+        :param key: key of the frame set
+        :return: cached uint16 average image and fractions of rejected pixels of every frame (None for plain mean) or
+        None
+        """
+        path = self.path(key, ".npz")
+        try:
+            with np.load(path) as data:
+                average = data["average"]
+                rejected = data["rejected"] if "rejected" in data.files else None
+            os.utime(path)  # mark entry as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        return average, rejected
+
+    def load_result(self, key):
+        """
+        :param key: key of the band calibration result
+        :return: cached calibrate_band result or None
+        """
+        path = self.path(key, ".json")
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path)  # mark entry as recently used
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def store_average(self, key, average, names, rejected=None):
+        """
+        :param key: key of the frame set
+        :param average: uint16 average image
+        :param names: filenames of the averaged images, kept for invalidation by directory
+        :param rejected: optional fractions of rejected pixels of every frame
+        """
+        arrays = {"average": average, "paths": np.array([os.path.abspath(name) for name in names])}
+        if rejected is not None:
+            arrays["rejected"] = rejected
+        self.write(self.path(key, ".npz"), lambda f: np.savez(f, **arrays))
+
+    def store_result(self, key, result, names):
+        """
+        :param key: key of the band calibration result
+        :param result: calibrate_band result
+        :param names: filenames of the band images, kept for invalidation by directory
+        """
+        entry = dict(result, paths=[os.path.abspath(name) for name in names])
+        self.write(self.path(key, ".json"), lambda f: f.write(json.dumps(entry).encode()))
+
+    def write(self, path, dump):
+        """
+        Write entry through a temporary file, so concurrent readers never see a partial entry, then evict old entries
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp, 'wb') as f:
+                dump(f)
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return  # caching is an optimization, a failed write must not break calibration
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (last use time, size, path) of cache entries
+        """
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        for name in os.listdir(self.folder):
+            if name.endswith(".npz") or name.endswith(".json"):
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits into its size limit
+        """
+        entries = sorted(self.entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    def invalidate(self, folders=None):
+        """
+        Remove cached entries
+        :param folders: remove only entries built from images of these directories, all entries if None
+        :return: number of removed entries
+        """
+        prefixes = None
+        if folders is not None:
+            prefixes = tuple(os.path.join(os.path.abspath(folder), '') for folder in folders)
+        removed = 0
+        for mtime, size, path in self.entries():
+            if prefixes is not None:
+                try:
+                    if path.endswith(".npz"):
+                        with np.load(path) as data:
+                            paths = [str(p) for p in data["paths"]]
+                    else:
+                        with open(path) as f:
+                            paths = json.load(f)["paths"]
+                except (OSError, ValueError, KeyError):
+                    paths = None  # unreadable entries are dropped as well
+                if paths is not None and not any(p.startswith(prefixes) for p in paths):
+                    continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+def calibrate(bands, blacklevel, fit_mode=FIT_MODE, jobs=BAND_JOBS, progress=None, cancel=None, cache=None,
+              references=None, center_mode=CENTER_MODE, average_mode=AVERAGE_MODE):
+    """
+    Run calibrate_band for every band. Bands are processed in parallel by a process pool, jobs=1 keeps everything in the
+    current process for deterministic debugging. Progress reports of worker processes are passed through a managed
+    queue and delivered to the progress callable in the calling thread. Results found in the cache are taken from it
+    without starting any process. CPU cores are split between band processes, so clipped averaging of every band gets
+    its share of tile threads instead of all cores
+    :param bands: list of band filenames lists
+    :param blacklevel: blacklevel to subtract from the average images
+    :param fit_mode: one of FIT_MODES
+    :param jobs: number of worker processes, None to use all CPU cores
+    :param progress: optional callable receiving calibrate_band progress reports
+    :param cancel: optional event, once it is set bands stop between frames or stages and CalibrationCancelled is
+    raised
+    :param cache: optional ResultCache
+    :param references: optional metadata index records of the first image of every band to average bands
+    incrementally, see incremental_average
+    :param center_mode: one of CENTER_MODES
+    :param average_mode: one of AVERAGE_MODES
+    :return: list of calibrate_band results in bands order
+    """
+    references = references or [None] * len(bands)
+    results = [None] * len(bands)
+    keys = [None] * len(bands)
+    if cache is not None:
+        for i, names in enumerate(bands):
+            meter = UsageMeter()
+            keys[i] = cache.frames_key(names, average_mode)
+            key = cache.result_key(keys[i], blacklevel, fit_mode, center_mode)
+            results[i] = cache.load_result(key)
+            if results[i] is not None:  # usage of the run which stored the result is replaced with the lookup one
+                results[i]["timings"] = {"cache": meter.stage("cache")["wall"]}
+                meter.total()
+                results[i]["usage"] = meter.stages
+                if progress is not None:
+                    progress(("average", i, len(names), len(names)))
+                    progress(("fit", i, 1, 1))
+    missing = [i for i in range(len(bands)) if results[i] is None]
+    if jobs == 1 or len(missing) <= 1:
+        for i in missing:
+            results[i] = calibrate_band(i, bands[i], blacklevel, fit_mode, progress, cancel, cache, references[i],
+                                        center_mode, average_mode, keys[i])
+        return results
+    context = multiprocessing.get_context(START_METHOD)
+    processes = min(jobs or os.cpu_count() or 1, len(missing))
+    tile_workers = max(1, (os.cpu_count() or 1) // processes)  # CPU cores are split between band processes
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        if progress is None and cancel is None:
+            futures = {i: pool.submit(calibrate_band, i, bands[i], blacklevel, fit_mode, None, None, cache,
+                                      references[i], center_mode, average_mode, keys[i], tile_workers)
+                       for i in missing}
+            for i in missing:
+                results[i] = futures[i].result()
+            return results
+        with context.Manager() as manager:
+            reports = manager.Queue()
+            stop = manager.Event()
+            futures = {i: pool.submit(calibrate_band, i, bands[i], blacklevel, fit_mode, reports.put, stop, cache,
+                                      references[i], center_mode, average_mode, keys[i], tile_workers)
+                       for i in missing}
+            pending = set(futures.values())
+            while pending:
+                done, pending = wait(pending, timeout=0.1)
+                if cancel is not None and cancel.is_set():
+                    stop.set()
+                while not reports.empty():
+                    report = reports.get()
+                    if progress is not None:
+                        progress(report)
+            for i in missing:
+                results[i] = futures[i].result()
+            return results
+
+
+def find_images(folder):
+    """
+    Find "img...tif" files in the directory
+    :param folder: directory with images
+    :return: sorted paths of the images
+    """
+    names = [name for name in os.listdir(folder) if name.startswith("img") and name.endswith(".tif")]
+    return [os.path.join(folder, name) for name in sorted(names)]
+
+
+def format_usage(usage):
+    """
+    :param usage: UsageMeter stage usage
+    :return: usage description for the text browser
+    """
+    text = "{:.2f} с, ЦП {:.2f} с".format(usage["wall"], usage["cpu"])
+    read = usage["mapped_bytes"] + (usage["read_chars"] or 0)  # mapped frames are not seen by read calls
+    text += ", прочитано {:.1f} МБ".format(read / 2 ** 20)
+    if usage["read_bytes"] is not None:
+        text += " (с диска {:.1f} МБ)".format(usage["read_bytes"] / 2 ** 20)
+    if usage["peak_rss"] is not None:
+        text += ", пик памяти {:.0f} МБ".format(usage["peak_rss"] / 2 ** 20)
+    return text
+
+
+def run_calibration(folder, fit_mode=FIT_MODE, jobs=BAND_JOBS, log=None, progress=None, cancel=None, cache=None,
+                    incremental=True, center_mode=CENTER_MODE, average_mode=AVERAGE_MODE):
+    """
+    Open all filtered images in the directory. If there are images in correct format, launch check_bands and use
+    returned images lists to calculate the vignette centers (theorized to correlate with mass center of the image) and
+    vignette coefficients as polynomial of pixels brightness approximation. Check if coefficients exceed proposed limits
+    and collect warnings. Neither current directory nor any global state is used, so several directories can be
+    calibrated concurrently
+    :param folder: directory with images of every band
+    :param fit_mode: one of FIT_MODES
+    :param jobs: number of processes calibrating bands, see calibrate
+    :param log: optional callable receiving notes for the text browser
+    :param progress: optional callable receiving ("scan", None, scanned, total) reports and calibrate_band reports
+    :param cancel: optional event, once it is set CalibrationCancelled is raised between stages or frames
+    :param cache: optional ResultCache
+    :param incremental: whether averaging state is kept next to the images, so the next run reads only new images
+    :param center_mode: one of CENTER_MODES
+    :param average_mode: one of AVERAGE_MODES
+    :return: dictionary with run status ("ok", "no_images" or "mismatch"), names of filtered images, calibrate_band
+    results, centers and coefficients strings, warnings, stage timings in seconds and UsageMeter stages of the run
+    and of every band
+    """
+    meter = UsageMeter()
+    timings = {}
+    summary = {"folder": folder, "status": "no_images", "filtered": [], "bands": [], "centers": [], "coefficients": [],
+               "warnings": [], "timings": timings, "usage": meter.stages}
+
+    def note(text):
+        if log is not None:
+            log(text)
+
+    img_list = find_images(folder)
+    if len(img_list) == 0:
+        note("Фотографии в директории отсутствуют")
+        return summary
+    note("Найдены следующие изображения: " + ", ".join(os.path.basename(name) for name in img_list))
+
+    def scanned(done, total):
+        if progress is not None:
+            progress(("scan", None, done, total))
+    index = build_meta_index(img_list, cache=os.path.join(folder, META_CACHE), progress=scanned, cancel=cancel)
+    img_list, filtered = meta_filter(img_list, index)
+    summary["filtered"] = filtered.split(", ") if filtered else []
+    for name in summary["filtered"]:
+        summary["warnings"].append("{}: no ISO speed or exposure time, ignored".format(name))
+    note("Следующие изображения не содержат необходимые теги и будут проигнорированы: {}".format(filtered))
+    meta_check, bands, img_width, img_height, blacklevel = check_bands(img_list, index)
+    timings["scan"] = meter.stage("scan")["wall"]
+    if not meta_check:
+        summary["status"] = "mismatch"
+        summary["warnings"].append("image metadata mismatch")
+        note("Обнаружены несовпадения в метаданных изображений")
+        return summary
+    if cancel is not None and cancel.is_set():
+        raise CalibrationCancelled()
+    note("Метаданные изображений совпадают, поиск параметров...")
+
+    references = [index[names[0]] for names in bands] if incremental else None
+    results = calibrate(bands, blacklevel, fit_mode, jobs, progress, cancel, cache, references, center_mode,
+                        average_mode)
+    if cancel is not None and cancel.is_set():  # set while the last bands were fitted, results are not reported
+        raise CalibrationCancelled()
+    timings["calibrate"] = meter.stage("calibrate")["wall"]
+    timings["bands"] = [result["timings"] for result in results]
+    meter.stages["bands"] = [result["usage"] for result in results]
+    for i, result in enumerate(results):
+        summary["centers"].append(result["center"])
+        summary["coefficients"].append(result["coefficient"])
+        note_text = "Центр виньетирования для канала {}: {}".format(i, result["center"].replace(";", ", "))
+        if "cache" in result["timings"]:
+            note_text += " (из кэша)"
+        elif result["reused_frames"]:
+            note_text += " (новых кадров: {}, из сохраненного состояния: {})".format(
+                len(bands[i]) - result["reused_frames"], result["reused_frames"])
+        note(note_text)
+        if result.get("rejected"):
+            note("Кадры канала {} в основном отброшены при усреднении: {}".format(i, ", ".join(
+                "{} ({:.0%})".format(name, fraction) for name, fraction in sorted(result["rejected"].items()))))
+            for name, fraction in sorted(result["rejected"].items()):
+                summary["warnings"].append("{}: {:.0%} of pixels rejected by clipping, bad capture".format(
+                    name, fraction))
+        note_text = "Коэффициенты полинома: " + ", ".join(str(check) for check in result["checks"])
+        if len(result["errors"]) != 0:  # if limits are exceeded, display exceeding coefficient
+            note_text += "; потенциально некачественные: "
+            note_text += ", ".join(str(result["checks"][err]) for err in result["errors"])
+            for err in result["errors"]:
+                summary["warnings"].append("band {}: coefficient {} = {} exceeds limit".format(
+                    i, err, result["checks"][err]))
+        if result["deviation"] is not None:
+            deviation = result["deviation"]
+            note_text += "; отклонение быстрого режима: коэффициенты {:.2%}, кривая {:.2e}".format(*deviation)
+            if deviation[1] > FIT_TOLERANCE:
+                note_text += " (превышает допуск {:.0e})".format(FIT_TOLERANCE)
+                summary["warnings"].append("band {}: binned fit deviates from curve_fit by {:.2e}".format(
+                    i, deviation[1]))
+        note(note_text)
+    summary["bands"] = results
+    summary["status"] = "ok"
+    timings["total"] = meter.total()["wall"]
+    note("Ресурсы: " + "; ".join("{} {}".format(STAGE_NAMES[name], format_usage(meter.stages[name]))
+                                 for name in ("scan", "calibrate", "total")))
+    for i, usage in enumerate(meter.stages["bands"]):
+        note("Ресурсы канала {}: {}; всего {}".format(i, ", ".join(
+            "{} {:.2f} с".format(STAGE_NAMES[name], stage["wall"]) for name, stage in usage.items() if name != "total"),
+            format_usage(usage["total"])))
+    return summary
+
+
+def write_tags(folder, centers, coefficients):
+    """
+    Format vignette parameters into .json and .ini files templates and save tags.json and tags.ini into the directory
+    :param folder: directory to save configuration files into
+    :param centers: vignette centers of every band as "x;y" strings
+    :param coefficients: vignette coefficients of every band as "1.1;2.2;0;4.4;0;6.6" strings
+    """
+    params = (centers[0], coefficients[0], centers[1], coefficients[1], centers[2], coefficients[2], centers[3],
+              coefficients[3], centers[4], coefficients[4])
+    json_string = '''
+                {
+                        "Cams": {
+                            "0": {
+                                "central_wavelength": "470",
+                                "band_name": "Blue",
+                                "wavelength_fwhm": "28",
+                                "fnumber": "1.8",
+                                "band_sensitivity": "0.83",
+                                "vignetting_center": "%s",
+                                "vignetting_polynomial": "%s",
+                                "radiometric_calibration": "0.000119266;0"
+                            },
+                            "1": {
+                                "central_wavelength": "560",
+                                "band_name": "Green",
+                                "wavelength_fwhm": "20",
+                                "fnumber": "1.8",
+                                "band_sensitivity": "0.8",
+                                "vignetting_center": "%s",
+                                "vignetting_polynomial": "%s",
+                                "radiometric_calibration": "0.000123596;0"
+                            },
+                            "2": {
+                                "central_wavelength": "665",
+                                "band_name": "Red",
+                                "wavelength_fwhm": "14",
+                                "fnumber": "1.8",
+                                "band_sensitivity": "0.4",
+                                "vignetting_center": "%s",
+                                "vignetting_polynomial": "%s",
+                                "radiometric_calibration": "0.000246559;0"
+                            },
+                            "3": {
+                                "central_wavelength": "720",
+                                "band_name": "Rededge",
+                                "wavelength_fwhm": "12",
+                                "fnumber": "1.8",
+                                "band_sensitivity": "0.307",
+                                "vignetting_center": "%s",
+                                "vignetting_polynomial": "%s",
+                                "radiometric_calibration": "0.000322352;0"
+                            },
+                            "4": {
+                                "central_wavelength": "840",
+                                "band_name": "NIR",
+                                "wavelength_fwhm": "40",
+                                "fnumber": "1.8",
+                                "band_sensitivity": "0.73",
+                                "vignetting_center": "%s",
+                                "vignetting_polynomial": "%s",
+                                "radiometric_calibration": "0.000135683;0"
                             }
-                            ''' % params
-            ini_string = '''
-                        [Cam0]
-                        central_wavelength=470
-                        band_name=Blue
-                        wavelength_fwhm=28
-                        fnumber=1.8
-                        band_sensitivity=0.83
-                        vignetting_center=%s
-                        vignetting_polynomial=%s
-                        radiometric_calibration=0.000119266;0
-
-                        [Cam1]
-                        central_wavelength=560
-                        band_name=Green
-                        wavelength_fwhm=20
-                        fnumber=1.8
-                        band_sensitivity=0.8
-                        vignetting_center=%s
-                        vignetting_polynomial=%s
-                        radiometric_calibration=0.000123596;0
-
-                        [Cam2]
-                        central_wavelength=668
-                        band_name=Red
-                        wavelength_fwhm=14
-                        fnumber=1.8
-                        band_sensitivity=0.4
-                        vignetting_center=%s
-                        vignetting_polynomial=%s
-                        radiometric_calibration=0.000246559;0
-
-                        [Cam3]
-                        central_wavelength=720
-                        band_name=Rededge
-                        wavelength_fwhm=12
-                        fnumber=1.8
-                        band_sensitivity=0.307
-                        vignetting_center=%s
-                        vignetting_polynomial=%s
-                        radiometric_calibration=0.000322352;0
-
-                        [Cam4]
-                        central_wavelength=840
-                        band_name=NIR
-                        wavelength_fwhm=40
-                        fnumber=1.8
-                        band_sensitivity=0.73
-                        vignetting_center=%s
-                        vignetting_polynomial=%s
-                        radiometric_calibration=0.000135683;0
-                        ''' % params
-
-            json_result = json.loads(json_string)  # create json object from json_string
-            with open('tags.json', 'w') as f:  # write json object as tags.json file
-                json.dump(json_result, f, indent=2)
-            config = configparser.ConfigParser(allow_no_value=True)  # setup config parser to work write .ini file
-            config.read_string(ini_string)
-            with open('tags.ini', 'w') as f:  # write parsed ini_string as tags.ini file
-                config.write(f)
-            self.text.append("Файлы были сохранены в директорию {}".format(folder))
-            self.btn_start.setEnabled(False)  # disable "Запустить скрипт" button until the new directory is opened
-            QtWidgets.qApp.processEvents()
+                        }
+                    }
+                    ''' % params
+    ini_string = '''
+                [Cam0]
+                central_wavelength=470
+                band_name=Blue
+                wavelength_fwhm=28
+                fnumber=1.8
+                band_sensitivity=0.83
+                vignetting_center=%s
+                vignetting_polynomial=%s
+                radiometric_calibration=0.000119266;0
+
+                [Cam1]
+                central_wavelength=560
+                band_name=Green
+                wavelength_fwhm=20
+                fnumber=1.8
+                band_sensitivity=0.8
+                vignetting_center=%s
+                vignetting_polynomial=%s
+                radiometric_calibration=0.000123596;0
+
+                [Cam2]
+                central_wavelength=668
+                band_name=Red
+                wavelength_fwhm=14
+                fnumber=1.8
+                band_sensitivity=0.4
+                vignetting_center=%s
+                vignetting_polynomial=%s
+                radiometric_calibration=0.000246559;0
+
+                [Cam3]
+                central_wavelength=720
+                band_name=Rededge
+                wavelength_fwhm=12
+                fnumber=1.8
+                band_sensitivity=0.307
+                vignetting_center=%s
+                vignetting_polynomial=%s
+                radiometric_calibration=0.000322352;0
+
+                [Cam4]
+                central_wavelength=840
+                band_name=NIR
+                wavelength_fwhm=40
+                fnumber=1.8
+                band_sensitivity=0.73
+                vignetting_center=%s
+                vignetting_polynomial=%s
+                radiometric_calibration=0.000135683;0
+                ''' % params
+
+    json_result = json.loads(json_string)  # create json object from json_string
+    with open(os.path.join(folder, 'tags.json'), 'w') as f:  # write json object as tags.json file
+        json.dump(json_result, f, indent=2)
+    config = configparser.ConfigParser(allow_no_value=True)  # setup config parser to work write .ini file
+    config.read_string(ini_string)
+    with open(os.path.join(folder, 'tags.ini'), 'w') as f:  # write parsed ini_string as tags.ini file
+        config.write(f)
+
+
+def write_report(folder, summary):
+    """
+    Save run_calibration summary with stage timings and resource usage as calibration_report.json, so a slow run can
+    be diagnosed from the files sent by the user
+    :param folder: directory to save the report into, usually the one with tags.json
+    :param summary: run_calibration summary
+    """
+    report = dict(summary, environment={
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    })
+    with open(os.path.join(folder, REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def run_profiled(folder, func, *args, **kwargs):
+    """
+    Run func under cProfile and tracemalloc and save calibration.prof (pstats format) and calibration_profile.txt with
+    the functions of the largest cumulative time and the largest allocation sites into the directory. Only the calling
+    thread is profiled, so bands should be calibrated in the same process and thread. The dumps are saved even if func
+    fails or is cancelled
+    :param folder: directory to save the dumps into, created if needed
+    :param func: callable to run
+    :return: func result
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        os.makedirs(folder, exist_ok=True)
+        profiler.dump_stats(os.path.join(folder, "calibration.prof"))
+        with open(os.path.join(folder, "calibration_profile.txt"), 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+            f.write("Peak traced memory: {:.1f} MB\n".format(peak / 2 ** 20))
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                f.write("{}\n".format(stat))
+
+
+def read_tags(path):
+    """
+    Read vignette parameters of every band from tags.json saved by write_tags
+    :param path: tags.json filename
+    :return: dictionary of ("x;y", "1.1;2.2;0;4.4;0;6.6") strings keyed by band number
+    """
+    with open(path) as f:
+        cams = json.load(f)["Cams"]
+    return {int(band): (cam["vignetting_center"], cam["vignetting_polynomial"]) for band, cam in cams.items()}
+
+
+@lru_cache(maxsize=16)
+def gain_map(img_width, img_height, center, polynomial):
+    """
+    Compute per-pixel vignetting correction gain 1 / poly6(r) of the band. Every band of the camera has its own map,
+    which is computed once and reused for all images of the band and resolution
+    :param img_width: image width in pixels
+    :param img_height: image height in pixels
+    :param center: vignette center as "x;y" string
+    :param polynomial: vignette coefficients as "1.1;2.2;0;4.4;0;6.6" string
+    :return: read-only float32 array of (img_height, img_width) shape
+    """
+    xc, yc = (float(value) for value in center.split(";"))
+    b, c, _, e, _, g = (float(value) for value in polynomial.split(";"))
+    V = poly6(radius_grid(img_width, img_height, xc, yc).T, b, c, e, g)
+    gain = np.divide(1, V, out=np.zeros_like(V), where=V > 0).astype(np.float32)  # the model is meaningless below 0
+    gain.flags.writeable = False  # map is shared between images and threads
+    return gain
+
+
+def load_frame(name):
+    """
+    Read the whole image file into memory, so the correction does not wait for disk and the corrected copy is written
+    from the same bytes. Only images with known blacklevel and pixel layout supported by tiff_view are read
+    :param name: image filename
+    :return: read_tiff_header result, file contents as bytearray
+    """
+    header = read_tiff_header(name)
+    if header["blacklevel"] is None:
+        raise ValueError("no BlackLevel tag")
+    data = bytearray(os.path.getsize(name))
+    with open(name, 'rb') as f:
+        f.readinto(data)
+    if tiff_view(name, header, data) is None:
+        raise ValueError("compressed or unsupported TIFF layout")
+    return header, data
+
+
+def correct_frame(data, header, out, gain_key):
+    """
+    Devignette the image and save its corrected copy. Pixels are replaced inside the file contents read by load_frame,
+    so all tags and metadata are kept byte for byte. Pixels are corrected in chunks of DEVIGNETTE_ROWS rows as
+    clip((pixel - blacklevel) * gain + blacklevel), blacklevel is added back since the copied BlackLevel tag still
+    describes the image
+    :param data: file contents of the image as bytearray, modified in place
+    :param header: read_tiff_header result of the image
+    :param out: filename of the corrected copy
+    :param gain_key: vignette center and polynomial strings of the image band, see gain_map
+    """
+    frame = tiff_view(out, header, data)
+    gain = gain_map(frame.shape[1], frame.shape[0], *gain_key)  # frame is oriented, header size is not
+    blacklevel = header["blacklevel"]
+    for start in range(0, frame.shape[0], DEVIGNETTE_ROWS):
+        stop = min(start + DEVIGNETTE_ROWS, frame.shape[0])
+        chunk = frame[start:stop].astype(np.float32)
+        chunk -= blacklevel
+        chunk *= gain[start:stop]
+        chunk += blacklevel
+        np.rint(chunk, out=chunk)
+        np.clip(chunk, 0, 65535, out=chunk)
+        frame[start:stop] = chunk
+    with open(out, 'wb') as f:
+        f.write(data)
+
+
+def devignette(names, tags, out, workers=DEVIGNETTE_WORKERS, read_ahead=READ_AHEAD, progress=None, cancel=None):
+    """
+    Correct vignetting of the images with parameters from tags.json and save the corrected copies into the output
+    directory. Images are read by a separate thread at most read_ahead images ahead of the correction, and corrected
+    on a thread pool (NumPy releases the GIL), so at most read_ahead + workers images are held in memory. The band of
+    an image is taken from its filename, image size and blacklevel from its TIFF header
+    :param names: filenames of the images
+    :param tags: tags.json filename
+    :param out: directory for corrected images, created if needed, must differ from the images directory
+    :param workers: number of correcting threads, None to use all CPU cores
+    :param read_ahead: number of images read ahead of the correction
+    :param progress: optional callable receiving (corrected, total) images count after every image
+    :param cancel: optional event checked between images, CalibrationCancelled is raised once it is set
+    :return: dictionary with numbers of corrected and skipped images, warnings, elapsed time in seconds and throughput
+    in images per second
+    """
+    start = time.perf_counter()
+    params = read_tags(tags)
+    os.makedirs(out, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    summary = {"out": out, "corrected": 0, "skipped": 0, "warnings": []}
+
+    def finish(future, name, target=None):
+        try:
+            future.result()
+            summary["corrected"] += 1
+        except (OSError, ValueError, KeyError, struct.error) as error:
+            summary["skipped"] += 1
+            summary["warnings"].append("{}: {}, skipped".format(os.path.basename(name), error))
+            if target is not None and os.path.exists(target):
+                os.remove(target)  # uncorrected copy must not be mistaken for a corrected image
+        if progress is not None:
+            progress(summary["corrected"] + summary["skipped"], len(names))
+
+    jobs = []
+    for name in names:
+        band = re.search(r"img(\d+)_", os.path.basename(name))
+        target = os.path.join(out, os.path.basename(name))
+        if os.path.abspath(target) == os.path.abspath(name):
+            raise ValueError("Output directory must differ from the images directory")
+        if band is None or int(band.group(1)) not in params:
+            summary["skipped"] += 1
+            summary["warnings"].append("{}: no vignette parameters of its band, skipped".format(
+                os.path.basename(name)))
+            continue
+        jobs.append((name, target, params[int(band.group(1))]))
+    reads = deque()
+    corrections = {}
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=workers) as pool:
+        for position in range(len(jobs) + read_ahead):
+            if cancel is not None and cancel.is_set():
+                for future in reads:
+                    future.cancel()
+                for future in corrections:
+                    future.cancel()  # copies are written by the corrections, running ones are finished on shutdown
+                raise CalibrationCancelled()
+            if position < len(jobs):
+                reads.append(reader.submit(load_frame, jobs[position][0]))
+            if position < read_ahead or not reads:
+                continue
+            name, target, (center, polynomial) = jobs[position - read_ahead]
+            future = reads.popleft()
+            if future.exception() is not None:
+                finish(future, name)
+                continue
+            header, data = future.result()
+            while len(corrections) >= workers:  # wait for a free worker, it bounds frames held in memory
+                done, _ = wait(corrections, return_when=FIRST_COMPLETED)
+                for finished in done:
+                    finish(finished, *corrections.pop(finished))
+            future = pool.submit(correct_frame, data, header, target, (center, polynomial))
+            corrections[future] = (name, target)
+        for future in as_completed(list(corrections)):
+            finish(future, *corrections.pop(future))
+    summary["elapsed"] = time.perf_counter() - start
+    summary["images_per_second"] = summary["corrected"] / max(summary["elapsed"], 1e-9)
+    return summary
+
+
+def calibrate_camera(folder, out, fit_mode=FIT_MODE, jobs=BAND_JOBS, cache=None, incremental=True,
+                     center_mode=CENTER_MODE, average_mode=AVERAGE_MODE, profile=False):
+    """
+    Calibrate one camera and save its configuration files
+    :param folder: directory with images of every band
+    :param out: directory to save tags.json and tags.ini into, created if needed
+    :param fit_mode: one of FIT_MODES
+    :param jobs: number of processes calibrating bands, see calibrate
+    :param cache: optional ResultCache
+    :param incremental: whether averaging state is kept next to the images, see run_calibration
+    :param center_mode: one of CENTER_MODES
+    :param average_mode: one of AVERAGE_MODES
+    :param profile: whether the run is profiled by run_profiled, bands are calibrated serially then
+    :return: run_calibration summary with output directory
+    """
+    if profile:
+        summary = run_profiled(out, run_calibration, folder, fit_mode, 1, cache=cache, incremental=incremental,
+                               center_mode=center_mode, average_mode=average_mode)
+    else:
+        summary = run_calibration(folder, fit_mode, jobs, cache=cache, incremental=incremental,
+                                  center_mode=center_mode, average_mode=average_mode)
+    if summary["status"] == "ok":
+        os.makedirs(out, exist_ok=True)
+        write_tags(out, summary["centers"], summary["coefficients"])
+        write_report(out, summary)
+    summary["out"] = out
+    return summary
+
+
+def summary_line(summary):
+    """
+    :param summary: calibrate_camera summary
+    :return: JSON line with camera results for batch mode output
+    """
+    keys = ("folder", "out", "status", "centers", "coefficients", "warnings", "timings", "error")
+    return json.dumps({key: summary[key] for key in keys if key in summary})
+
+
+def output_dirs(dirs, out):
+    """
+    Output directory of every input directory is named after it, repeated names get a numeric suffix
+    :param dirs: input directories
+    :param out: directory to create the output directories in
+    :return: output directories list in dirs order
+    """
+    outs = []
+    for folder in dirs:
+        name = os.path.basename(os.path.normpath(os.path.abspath(folder)))
+        path = os.path.join(out, name)
+        suffix = 1
+        while path in outs:
+            suffix += 1
+            path = os.path.join(out, "{}_{}".format(name, suffix))
+        outs.append(path)
+    return outs
+
+
+def command_calibrate(args):
+    """
+    Calibrate every camera directory and print JSON summary line for each camera as soon as it is done. Several
+    directories are processed concurrently, one process per camera; a single directory uses the processes for bands
+    :param args: parsed command line arguments
+    :return: exit code, 0 if all cameras were calibrated
+    """
+    outs = output_dirs(args.dirs, args.out)
+    cache = None if args.no_cache else ResultCache(args.cache_dir, content_hash=args.hash)
+    failed = 0
+    if len(args.dirs) == 1 or args.jobs == 1:
+        for folder, out in zip(args.dirs, outs):
+            try:
+                summary = calibrate_camera(folder, out, args.fit_mode, args.jobs, cache, not args.full,
+                                           args.center_mode, args.average_mode, args.profile)
+            except Exception as error:
+                summary = {"folder": folder, "out": out, "status": "error", "error": str(error)}
+            failed += summary["status"] != "ok"
+            print(summary_line(summary), flush=True)
+        return int(failed > 0)
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context(START_METHOD)) as pool:
+        futures = {pool.submit(calibrate_camera, folder, out, args.fit_mode, 1, cache, not args.full,
+                               args.center_mode, args.average_mode, args.profile): (folder, out)
+                   for folder, out in zip(args.dirs, outs)}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as error:
+                folder, out = futures[future]
+                summary = {"folder": folder, "out": out, "status": "error", "error": str(error)}
+            failed += summary["status"] != "ok"
+            print(summary_line(summary), flush=True)
+    return int(failed > 0)
+
+
+def command_invalidate(args):
+    """
+    Remove cached calibration results of the given directories, or the whole cache
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    removed = ResultCache(args.cache_dir).invalidate(args.dirs or None)
+    print(json.dumps({"cache": args.cache_dir, "removed": removed}))
+    return 0
+
+
+def command_devignette(args):
+    """
+    Correct vignetting of every captures directory with parameters from tags.json and print JSON summary line for each
+    directory with its throughput
+    :param args: parsed command line arguments
+    :return: exit code, 0 if all images were corrected
+    """
+    failed = 0
+    for folder, out in zip(args.dirs, output_dirs(args.dirs, args.out)):
+        try:
+            summary = devignette(find_images(folder), args.tags, out, args.workers, args.read_ahead)
+            summary["status"] = "ok" if summary["skipped"] == 0 else "partial"
+        except Exception as error:
+            summary = {"out": out, "status": "error", "error": str(error)}
+        summary["folder"] = folder
+        failed += summary["status"] != "ok"
+        print(json.dumps(summary), flush=True)
+    return int(failed > 0)
+
+
+def main(argv=None):
+    """
+    Start the GUI, or run a headless command if one is given
+    :param argv: command line arguments, sys.argv[1:] by default
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(description="Vignette Finder. Without a command the GUI is started")
+    commands = parser.add_subparsers(dest="command")
+    calibrate_parser = commands.add_parser("calibrate", help="calibrate cameras without GUI")
+    calibrate_parser.add_argument("dirs", nargs="+", help="directories with images of every band, one per camera")
+    calibrate_parser.add_argument("--out", required=True, help="directory for per-camera tags.json and tags.ini")
+    calibrate_parser.add_argument("--jobs", type=int, default=None, help="worker processes, all CPU cores by default")
+    calibrate_parser.add_argument("--fit-mode", choices=FIT_MODES, default=FIT_MODE, help="poly6 approximation mode")
+    calibrate_parser.add_argument("--center-mode", choices=CENTER_MODES, default=CENTER_MODE,
+                                  help="vignette center search: center of mass or joint fit with the polynomial")
+    calibrate_parser.add_argument("--average-mode", choices=AVERAGE_MODES, default=AVERAGE_MODE,
+                                  help="frame averaging: plain mean or sigma-clipped mean rejecting outliers")
+    calibrate_parser.add_argument("--profile", action="store_true",
+                                  help="profile the run with cProfile and tracemalloc, dumps are saved with tags.json")
+    calibrate_parser.add_argument("--cache-dir", default=CACHE_DIR, help="calibration results cache directory")
+    calibrate_parser.add_argument("--no-cache", action="store_true", help="do not use calibration results cache")
+    calibrate_parser.add_argument("--hash", action="store_true",
+                                  help="identify frames by content hash instead of size and modification time")
+    calibrate_parser.add_argument("--full", action="store_true",
+                                  help="average all images instead of adding new ones to the saved averaging state")
+    invalidate_parser = commands.add_parser("invalidate", help="remove cached calibration results")
+    invalidate_parser.add_argument("dirs", nargs="*", help="capture directories to forget, whole cache if omitted")
+    invalidate_parser.add_argument("--cache-dir", default=CACHE_DIR, help="calibration results cache directory")
+    devignette_parser = commands.add_parser("devignette", help="correct vignetting of images with saved parameters")
+    devignette_parser.add_argument("dirs", nargs="+", help="directories with images to correct")
+    devignette_parser.add_argument("--tags", required=True, help="tags.json with vignette parameters of every band")
+    devignette_parser.add_argument("--out", required=True, help="directory for corrected copies of every directory")
+    devignette_parser.add_argument("--workers", type=int, default=DEVIGNETTE_WORKERS,
+                                   help="correcting threads, all CPU cores by default")
+    devignette_parser.add_argument("--read-ahead", type=int, default=READ_AHEAD,
+                                   help="images read into memory ahead of the correction")
+    args = parser.parse_args(argv)
+    if args.command == "calibrate":
+        return command_calibrate(args)
+    if args.command == "invalidate":
+        return command_invalidate(args)
+    if args.command == "devignette":
+        return command_devignette(args)
+    from gui import run_gui  # Qt is imported only when the window is shown
+    return run_gui()
 
 
 if __name__ == "__main__":
-    app = QtWidgets.QApplication(sys.argv)  # initialize Qt app with system arguments
-    MainWindow = QtWidgets.QMainWindow()
-    ui = Ui_MainWindow()
-    ui.setupUi(MainWindow)
-    MainWindow.show()  # display Qt GUI using Ui_MainWindow Class methods
-    sys.exit(app.exec_())  # finish the program once app is closed
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+from fractions import Fraction
+import numpy as np
+import scipy
+from scipy import ndimage
+import app
+
+BAND_NAMES = ("Blue", "Green", "Red", "Rededge", "NIR")  # band names of write_tags templates
+# Ground truth vignette center offsets from the image center (as image size fractions) and poly6 coefficients b, c, e, g
+# of every band for 1440x1080 frames, close to the ones found for example_input
+TRUTH = (
+    ((0.0014, 0.0002), (4.2e-05, -2.1e-07, 2.5e-13, -7.8e-19)),
+    ((0.0017, -0.0006), (-3.9e-05, -3.6e-08, -1.6e-13, -4.1e-19)),
+    ((-0.0018, 0.0019), (5.3e-06, -1.1e-07, 6.9e-14, -6.3e-19)),
+    ((-0.0046, -0.0028), (3.1e-05, -2.4e-07, 2.0e-13, -6.5e-19)),
+    ((-0.0087, -0.0083), (4.8e-05, -2.6e-07, 4.0e-13, -8.6e-19)),
+)
+TIFF_FORMATS = {1: "B", 2: "s", 3: "H", 4: "I", 5: "I"}  # struct formats of BYTE, ASCII, SHORT, LONG and RATIONAL
+LEVEL = 20000  # brightness of the vignette center above blacklevel in DN
+ISO = 1585
+EXPOSURE = Fraction(1, 400)
+STARTUP_BUDGET = 0.5  # seconds allowed for the command line to start, see measure_startup
+HEAVY_MODULES = ("numpy", "scipy", "pyexiv2", "PIL", "PyQt5", "matplotlib", "pandas")  # not imported on startup
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({"import": elapsed, "modules": [name for name in json.loads(sys.argv[1]) if name in sys.modules]}))
+"""
+
+
+def band_truth(band, width, height):
+    """
+    Ground truth of the synthetic band. Coefficients are rescaled to the frame diagonal, so the vignetting looks the
+    same at any resolution
+    :param band: band number
+    :param width: image width in pixels
+    :param height: image height in pixels
+    :return: vignette center x and y coordinates, poly6 coefficients b, c, e, g
+    """
+    (dx, dy), (b, c, e, g) = TRUTH[band]
+    scale = np.hypot(width, height) / np.hypot(1440, 1080)
+    return (width / 2 + dx * width, height / 2 + dy * height,
+            (b / scale, c / scale ** 2, e / scale ** 4, g / scale ** 6))
+
+
+def xmp_packet(band):
+    """
+    :param band: band number
+    :return: XMP packet with the Camera namespace tags of Pollux images
+    """
+    return ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+            ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+            '  <rdf:Description rdf:about="" xmlns:Camera="http://pix4d.com/camera/1.0"\n'
+            '   Camera:BandName="{}" Camera:RigName="Pollux" Camera:RigCameraIndex="{}"/>\n'
+            ' </rdf:RDF>\n'
+            '</x:xmpmeta>\n'
+            '<?xpacket end="w"?>').format(BAND_NAMES[band], band).encode()
+
+
+def ifd_bytes(entries, offset):
+    """
+    Serialize little-endian TIFF IFD with its out-of-line values placed right after it
+    :param entries: list of (tag, type, values) with bytes values for BYTE and ASCII types and (numerator, denominator)
+    pairs for RATIONAL type
+    :param offset: file offset the IFD is written at
+    :return: IFD bytes
+    """
+    entries = sorted(entries)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    body = struct.pack('<H', len(entries))
+    extra = b''
+    for tag, kind, values in entries:
+        if kind in (1, 2):
+            payload = bytes(values)
+            count = len(payload)
+        else:
+            flat = [value for pair in values for value in pair] if kind == 5 else list(values)
+            payload = struct.pack('<' + TIFF_FORMATS[kind] * len(flat), *flat)
+            count = len(values)
+        if len(payload) <= 4:
+            field = payload.ljust(4, b'\0')
+        else:
+            field = struct.pack('<I', data_offset + len(extra))
+            extra += payload + b'\0' * (len(payload) % 2)  # values start on a word boundary
+        body += struct.pack('<HHI', tag, kind, count) + field
+    return body + struct.pack('<I', 0) + extra
+
+
+def write_tiff(name, pixels, band, blacklevel, orientation=2):
+    """
+    Write uint16 frame as an uncompressed single-strip TIFF with the tags read by read_meta and read_tiff_header: size
+    and layout, Orientation, BlackLevel, XMP packet with BandName and Exif sub-IFD with ISOSpeedRatings and ExposureTime
+    :param name: image filename
+    :param pixels: uint16 frame of (img_height, img_width) shape as it should be displayed
+    :param band: band number
+    :param blacklevel: BlackLevel tag value
+    :param orientation: Orientation tag value, pixels are stored so that the oriented image equals pixels
+    """
+    transpose, rows, columns = app.TIFF_ORIENTATIONS[orientation]
+    raw = pixels[::rows, ::columns]  # inverse of the tiff_view transform
+    if transpose:
+        raw = raw.T
+    data = np.ascontiguousarray(raw, dtype='<u2').tobytes()
+    height, width = raw.shape
+    blacklevel = Fraction(blacklevel).limit_denominator()
+    exposure = (EXPOSURE.numerator, EXPOSURE.denominator)
+
+    def entries(exif_offset):
+        return [
+            (254, 4, [0]), (256, 4, [width]), (257, 4, [height]), (258, 3, [16]), (259, 3, [1]), (262, 3, [1]),
+            (271, 2, b"Geoscan\0"), (272, 2, b"Pollux\0"), (273, 4, [8]), (274, 3, [orientation]),
+            (277, 3, [1]), (278, 4, [height]), (279, 4, [len(data)]), (284, 3, [1]), (700, 1, xmp_packet(band)),
+            (34665, 4, [exif_offset]), (50714, 5, [(blacklevel.numerator, blacklevel.denominator)]),
+        ]
+    ifd_offset = 8 + len(data)
+    exif_offset = ifd_offset + len(ifd_bytes(entries(0), ifd_offset))
+    with open(name, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        f.write(data)
+        f.write(ifd_bytes(entries(exif_offset), ifd_offset))
+        f.write(ifd_bytes([(33434, 5, [exposure]), (34855, 3, [ISO])], exif_offset))
+
+
+def generate_dataset(folder, width=1440, height=1080, frames=10, noise=50.0, blacklevel=3840, seed=0, orientation=2):
+    """
+    Write synthetic Pollux-like captures of evenly lit white wall: frames of every band are
+    blacklevel + LEVEL * poly6(r) with Gaussian noise, named as the camera names them
+    :param folder: directory to write images into, created if needed
+    :param width: image width in pixels
+    :param height: image height in pixels
+    :param frames: number of frames of every band
+    :param noise: noise standard deviation in DN
+    :param blacklevel: BlackLevel of the images
+    :param seed: random generator seed
+    :param orientation: Orientation tag of the images
+    :return: list of band_truth results of every band
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    truth = []
+    for band in range(len(BAND_NAMES)):
+        xc, yc, popt = band_truth(band, width, height)
+        truth.append((xc, yc, popt))
+        flat = blacklevel + LEVEL * app.poly6(app.radius_grid(width, height, xc, yc).T, *popt)
+        for i in range(frames):
+            frame = np.clip(np.rint(flat + rng.normal(0, noise, flat.shape)), 0, 65535).astype(np.uint16)
+            write_tiff(os.path.join(folder, "img{}_{:04d}.tif".format(band, i + 1)), frame, band, blacklevel,
+                       orientation)
+    return truth
+
+
+def timed(func, repeat):
+    """
+    Run func repeatedly with cold in-process caches
+    :param func: callable without arguments
+    :param repeat: number of runs
+    :return: last func result, list of run times in seconds
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        app.radius_grid.cache_clear()
+        app.gain_map.cache_clear()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def measure_startup(repeat=3):
+    """
+    Time import of app in fresh interpreters, as the command line and the window pay it on every start
+    :param repeat: number of interpreter runs
+    :return: list of import times in seconds, heavy modules imported with app
+    """
+    times = []
+    modules = []
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, json.dumps(HEAVY_MODULES)], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        times.append(result["import"])
+        modules = result["modules"]
+    return times, modules
+
+
+def run_benchmark(folder, truth, repeat=3, curve_fit=False, clipped=False):
+    """
+    Time every calibration stage over all bands of the dataset, the whole calibration and devignetting, and check
+    found centers and polynomials against the ground truth
+    :param folder: directory with generated images
+    :param truth: generate_dataset result
+    :param repeat: number of runs of every stage, the fastest and the median ones are reported
+    :param curve_fit: whether the reference curve_fit approximation is timed as well
+    :param clipped: whether sigma-clipped averaging is timed as well
+    :return: dictionary with stage timings and accuracy
+    """
+    img_list = app.find_images(folder)
+    stages = {}
+    times, modules = measure_startup(repeat)
+    stages["startup"] = {"min": min(times), "median": statistics.median(times)}
+
+    def stage(key, func, frames=None):
+        result, times = timed(func, repeat)
+        stages[key] = {"min": min(times), "median": statistics.median(times)}
+        if frames is not None:
+            stages[key]["frames_per_second"] = frames / min(times)
+        return result
+
+    def scan():
+        index = app.build_meta_index(img_list)
+        names, _ = app.meta_filter(img_list, index)
+        return app.check_bands(names, index)
+    meta_check, bands, img_width, img_height, blacklevel = stage("scan", scan)
+    if not meta_check:
+        raise ValueError("Generated images metadata mismatch")
+    frames = sum(len(names) for names in bands)
+    images = stage("average", lambda: [app.average_frames(names)[0].T - blacklevel for names in bands], frames)
+    if clipped:
+        stage("average_clipped", lambda: [app.clipped_average(names)[0] for names in bands], frames)
+    coms = stage("center", lambda: [ndimage.center_of_mass(image) for image in images])
+    joints = stage("center_joint", lambda: [app.fit_center(image, *com) for image, com in zip(images, coms)])
+    centers = [(int(com[0]), int(com[1])) for com in coms]
+    profiles = stage("profile", lambda: [app.radial_profile(image, *center)
+                                         for image, center in zip(images, centers)])
+    fits = stage("fit", lambda: [app.fit_poly6(r, V) for r, V in profiles])
+    if curve_fit:
+        stage("fit_curve_fit", lambda: [app.fit_poly6(r, V, "curve_fit") for r, V in profiles])
+    summary = stage("calibration", lambda: app.run_calibration(folder, jobs=1, incremental=False), frames)
+    tags = os.path.join(folder, "tags.json")
+    app.write_tags(folder, ["{};{}".format(xc, yc) for xc, yc, popt in truth],
+                   [app.format_coefficients(np.array(popt))[1] for xc, yc, popt in truth])
+    with tempfile.TemporaryDirectory() as out:
+        devignetted = stage("devignette", lambda: app.devignette(img_list, tags, out), len(img_list))
+        if devignetted["corrected"] < len(img_list):
+            raise ValueError("Devignetting corrected {} of {} images: {}".format(
+                devignetted["corrected"], len(img_list), "; ".join(devignetted["warnings"][:3])))
+        corrected = app.find_images(out)
+        flatness = []
+        for band in range(len(BAND_NAMES)):
+            names = [name for name in corrected if os.path.basename(name).startswith("img{}_".format(band))]
+            image = app.average_frames(names)[0].astype(np.float64) - blacklevel
+            flatness.append(float(np.std(image) / LEVEL))
+
+    accuracy = []
+    for band, (xc, yc, popt) in enumerate(truth):
+        r_max = float(np.hypot(max(xc, img_width - xc), max(yc, img_height - yc)))
+        joint_profile = app.radial_profile(images[band], *joints[band])
+        calibrated = [float(value) for value in summary["bands"][band]["checks"]]
+        accuracy.append({
+            "center_error": float(np.hypot(coms[band][0] - xc, coms[band][1] - yc)),
+            "joint_center_error": float(np.hypot(joints[band][0] - xc, joints[band][1] - yc)),
+            "curve_error": float(app.fit_deviation(fits[band], popt, r_max)[1]),
+            "joint_curve_error": float(app.fit_deviation(app.fit_poly6(*joint_profile), popt, r_max)[1]),
+            "calibration_curve_error": float(app.fit_deviation(
+                [calibrated[0], calibrated[1], calibrated[3], calibrated[5]], popt, r_max)[1]),
+            "devignetted_flatness": flatness[band],
+        })
+    return {"stages": stages, "accuracy": accuracy, "startup_modules": modules}
+
+
+def compare(results, previous, tolerance):
+    """
+    Compare stage timings with the results of a previous run
+    :param results: run_benchmark results
+    :param previous: results of a previous run
+    :param tolerance: largest allowed ratio of the current to the previous fastest stage time
+    :return: list of (stage, ratio, regressed) for stages present in both runs
+    """
+    rows = []
+    for key, timing in results["stages"].items():
+        if key in previous.get("stages", {}):
+            ratio = timing["min"] / max(previous["stages"][key]["min"], 1e-9)
+            rows.append((key, ratio, ratio > tolerance))
+    return rows
+
+
+def main(argv=None):
+    """
+    Generate synthetic dataset, run the benchmark and save JSON results. No GUI is created, so the benchmark runs
+    on machines without a display
+    :param argv: command line arguments, sys.argv[1:] by default
+    :return: exit code, 1 if startup is over the budget or a stage regressed against --compare results
+    """
+    parser = argparse.ArgumentParser(description="Vignette Finder calibration benchmark on synthetic frames")
+    parser.add_argument("--width", type=int, default=1440, help="frame width")
+    parser.add_argument("--height", type=int, default=1080, help="frame height")
+    parser.add_argument("--frames", type=int, default=10, help="frames of every band")
+    parser.add_argument("--noise", type=float, default=50.0, help="noise standard deviation in DN")
+    parser.add_argument("--blacklevel", type=float, default=3840, help="BlackLevel of the frames")
+    parser.add_argument("--orientation", type=int, choices=sorted(app.TIFF_ORIENTATIONS), default=2,
+                        help="Orientation tag of the frames, Pollux writes 2")
+    parser.add_argument("--seed", type=int, default=0, help="noise generator seed")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every stage")
+    parser.add_argument("--curve-fit", action="store_true", help="time the reference curve_fit approximation too")
+    parser.add_argument("--clipped", action="store_true", help="time sigma-clipped averaging too")
+    parser.add_argument("--dir", help="directory for generated frames, kept after the run; temporary by default")
+    parser.add_argument("--out", default="benchmark_results.json", help="JSON results filename")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare stage timings with")
+    parser.add_argument("--tolerance", type=float, default=1.2,
+                        help="stage time ratio to the previous run considered a regression")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET,
+                        help="seconds allowed for import of app in a fresh interpreter")
+    args = parser.parse_args(argv)
+    config = {key: getattr(args, key) for key in ("width", "height", "frames", "noise", "blacklevel", "orientation",
+                                                  "seed", "repeat")}
+    with tempfile.TemporaryDirectory() as temp:
+        folder = args.dir or temp
+        start = time.perf_counter()
+        truth = generate_dataset(folder, args.width, args.height, args.frames, args.noise, args.blacklevel, args.seed,
+                                 args.orientation)
+        generation = time.perf_counter() - start
+        results = run_benchmark(folder, truth, args.repeat, args.curve_fit, args.clipped)
+    results = dict(config=config, generation=generation, **results)
+    results["environment"] = {"python": platform.python_version(), "numpy": np.__version__,
+                              "scipy": scipy.__version__, "platform": platform.platform(), "cpus": os.cpu_count()}
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    for key, timing in results["stages"].items():
+        line = "{:<16}{:>10.4f} s".format(key, timing["min"])
+        if "frames_per_second" in timing:
+            line += "{:>12.1f} frames/s".format(timing["frames_per_second"])
+        print(line)
+    for band, accuracy in enumerate(results["accuracy"]):
+        print("band {}: center error {:.2f} px (joint {:.3f} px), curve error {:.2e} (joint {:.2e}), "
+              "devignetted flatness {:.4f}".format(band, accuracy["center_error"], accuracy["joint_center_error"],
+                                                    accuracy["curve_error"], accuracy["joint_curve_error"],
+                                                    accuracy["devignetted_flatness"]))
+    regressed = False
+    if results["startup_modules"]:
+        print("startup imports {}".format(", ".join(results["startup_modules"])))
+        regressed = True
+    if results["stages"]["startup"]["min"] > args.startup_budget:
+        print("startup is over the {} s budget".format(args.startup_budget))
+        regressed = True
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for key, ratio, slower in compare(results, previous, args.tolerance):
+            print("{:<16}{:>8.2f}x{}".format(key, ratio, " REGRESSION" if slower else ""))
+            regressed = regressed or slower
+    return int(regressed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
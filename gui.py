@@ -0,0 +1,282 @@
+import os
+import sys
+import threading
+import time
+from PyQt5 import QtCore, QtGui, QtWidgets
+from app import AVERAGE_MODE, BAND_JOBS, CENTER_MODE, FIT_MODE, FIT_MODES, PROFILE_ENV, CalibrationCancelled, \
+    ResultCache, run_calibration, run_profiled, write_report, write_tags
+
+
+class CalibrationWorker(QtCore.QThread):
+    """
+    Background thread running run_calibration on the images of the opened directory, so the window stays responsive.
+    Messages for the text browser, per-stage progress with elapsed time and throughput and final results are sent with
+    signals. The run can be cancelled between frames
+    """
+
+    message = QtCore.pyqtSignal(str)  # note for the text browser
+    progress = QtCore.pyqtSignal(int, int, str)  # done and total steps of the current stage, stage description
+    succeeded = QtCore.pyqtSignal(object)  # run_calibration summary, sent only if all bands are calibrated
+
+    def __init__(self, folder, fit_mode=FIT_MODE, jobs=BAND_JOBS, cache=None, center_mode=CENTER_MODE,
+                 average_mode=AVERAGE_MODE, profile=None):
+        super().__init__()
+        self.folder = folder
+        self.fit_mode = fit_mode
+        self.center_mode = center_mode
+        self.average_mode = average_mode
+        self.jobs = jobs
+        self.cache = cache
+        self.cancel_event = threading.Event()
+        self.start_time = None
+        self.average_start = None
+        self.averaged = {}  # frames averaged so far and total frames of every band
+        self.profile = profile  # directory to save the run profile into, None to run without profiling
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        try:
+            if self.profile:  # bands are calibrated in this thread, so the profile covers them
+                summary = run_profiled(self.profile, run_calibration, self.folder, self.fit_mode, 1, self.message.emit,
+                                       self.report, self.cancel_event, self.cache, center_mode=self.center_mode,
+                                       average_mode=self.average_mode)
+                self.message.emit("Профиль сохранен в директорию {}".format(self.profile))
+            else:
+                summary = run_calibration(self.folder, self.fit_mode, self.jobs, self.message.emit, self.report,
+                                          self.cancel_event, self.cache, center_mode=self.center_mode,
+                                          average_mode=self.average_mode)
+        except CalibrationCancelled:
+            self.message.emit("Обработка отменена")
+            return
+        except Exception as error:  # report any failure instead of silently killing the thread
+            self.message.emit("Ошибка обработки: {}".format(error))
+            return
+        if summary["status"] == "ok":
+            elapsed = time.perf_counter() - self.start_time
+            frames = sum(total for done, total in self.averaged.values())
+            self.progress.emit(frames, frames, "Готово: {} кадров за {:.1f} с, {:.1f} кадр/с".format(
+                frames, elapsed, frames / max(summary["timings"]["calibrate"], 1e-9)))
+            self.message.emit("Скрипт завершен за {:.1f} с, сохраните файлы конфигурации".format(elapsed))
+            self.succeeded.emit(summary)
+
+    def report(self, item):
+        """
+        Convert run_calibration progress reports into progress signals with elapsed time and throughput
+        """
+        stage, band, done, total = item
+        now = time.perf_counter()
+        if stage == "scan":
+            self.average_start = now  # averaging starts right after the last header is read
+            self.progress.emit(done, total, "Чтение метаданных: {}/{}, {:.1f} с".format(
+                done, total, now - self.start_time))
+        elif stage == "average":
+            self.averaged[band] = (done, total)
+            frames_done = sum(frames for frames, _ in self.averaged.values())
+            note = "Канал {}: кадр {}/{}, {:.1f} кадр/с, {:.1f} с".format(
+                band, done, total, frames_done / max(now - self.average_start, 1e-9), now - self.start_time)
+            self.progress.emit(frames_done, sum(frames for _, frames in self.averaged.values()), note)
+        else:
+            self.message.emit("Аппроксимация канала {} завершена, {:.1f} с".format(band, now - self.start_time))
+
+
+class Ui_MainWindow(object):
+    """
+    Qt-generated GUI Class with implemented open_file, finder and save_file functions. Open directory with
+    images of Geoscan Pollux bands. Launch the main script to calculate vignette coefficients and store them.
+    Save tags.json and tags.ini configuration files in chosen directory
+
+    The GUI contains text browser and progress bar to inform the user about the calibration progress. The main script
+    runs in CalibrationWorker thread and can be cancelled with "Отмена" button
+    """
+
+    def setupUi(self, MainWindow):
+        MainWindow.setObjectName("MainWindow")
+        MainWindow.setFixedSize(543, 408)
+        self.centralwidget = QtWidgets.QWidget(MainWindow)
+        self.centralwidget.setObjectName("centralwidget")
+        self.label = QtWidgets.QLabel(self.centralwidget)
+        self.label.setGeometry(QtCore.QRect(0, 20, 540, 50))
+        font = QtGui.QFont()
+        font.setFamily("Ubuntu Mono")
+        font.setPointSize(16)
+        font.setBold(True)
+        font.setWeight(75)
+        self.label.setFont(font)
+        self.label.setStyleSheet("")
+        self.label.setAlignment(QtCore.Qt.AlignCenter)
+        self.label.setObjectName("label")
+        self.text = QtWidgets.QTextBrowser(self.centralwidget)
+        self.text.setGeometry(QtCore.QRect(15, 65, 520, 275))
+        self.text.setStyleSheet("")
+        self.text.setObjectName("text")
+        self.progress = QtWidgets.QProgressBar(self.centralwidget)
+        self.progress.setGeometry(QtCore.QRect(15, 343, 520, 24))
+        self.progress.setValue(0)
+        self.progress.setObjectName("progress")
+        self.btn_start = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_start.setEnabled(False)
+        self.btn_start.setGeometry(QtCore.QRect(15, 370, 150, 30))
+        self.btn_start.setObjectName("btn_start")
+        self.fit_mode = QtWidgets.QComboBox(self.centralwidget)
+        self.fit_mode.setGeometry(QtCore.QRect(170, 370, 150, 30))
+        self.fit_mode.setObjectName("fit_mode")
+        self.btn_cancel = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_cancel.setEnabled(False)
+        self.btn_cancel.setGeometry(QtCore.QRect(325, 370, 95, 30))
+        self.btn_cancel.setObjectName("btn_cancel")
+        self.btn_clear = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_clear.setGeometry(QtCore.QRect(425, 370, 110, 30))
+        self.btn_clear.setObjectName("btn_clear")
+        self.line = QtWidgets.QFrame(self.centralwidget)
+        self.line.setGeometry(QtCore.QRect(0, 10, 543, 30))
+        self.line.setFrameShape(QtWidgets.QFrame.HLine)
+        self.line.setFrameShadow(QtWidgets.QFrame.Sunken)
+        self.line.setObjectName("line")
+        self.btn_open = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_open.setGeometry(QtCore.QRect(0, 0, 80, 25))
+        self.btn_open.setAutoFillBackground(False)
+        self.btn_open.setStyleSheet("")
+        self.btn_open.setObjectName("btn_open")
+        self.btn_save = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_save.setEnabled(False)
+        self.btn_save.setGeometry(QtCore.QRect(80, 0, 90, 25))
+        self.btn_save.setObjectName("btn_save")
+        self.joint_center = QtWidgets.QCheckBox(self.centralwidget)
+        self.joint_center.setGeometry(QtCore.QRect(380, 0, 160, 25))
+        self.joint_center.setObjectName("joint_center")
+        self.clipped = QtWidgets.QCheckBox(self.centralwidget)
+        self.clipped.setGeometry(QtCore.QRect(215, 0, 160, 25))
+        self.clipped.setObjectName("clipped")
+        MainWindow.setCentralWidget(self.centralwidget)
+        self.folder = None  # directory opened by the user
+        self.centers = []  # vignette centers of the last successful run as "x;y" strings
+        self.coefficients = []  # vignette coefficients of the last successful run as "1.1;2.2;0;4.4;0;6.6" strings
+        self.summary = None  # run_calibration summary of the last successful run, saved as calibration_report.json
+        self.worker = None  # CalibrationWorker of the running calibration
+        self.retranslateUi(MainWindow)
+        QtCore.QMetaObject.connectSlotsByName(MainWindow)
+
+    def retranslateUi(self, MainWindow):
+        _translate = QtCore.QCoreApplication.translate
+        MainWindow.setWindowTitle(_translate("MainWindow", "Vignette Finder"))
+        self.label.setText(_translate("MainWindow", "Определение параметров виньетирования"))
+        self.text.setHtml(_translate("MainWindow", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
+"<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
+"p, li { white-space: pre-wrap; }\n"
+"</style></head><body style=\" font-family:\'Ubuntu\'; font-size:11pt; font-weight:400; font-style:normal;\">\n"
+"<p style=\" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><span style=\" color:#000000;\">"
+                                                   "Чтобы начать, откройте директорию с фотографиями</span></p></body></html>"))
+        self.btn_open.setText(_translate("MainWindow", "Открыть"))
+        self.btn_open.clicked.connect(self.open_file)
+        self.btn_start.setText(_translate("MainWindow", "Запустить скрипт"))
+        self.btn_start.clicked.connect(self.finder)
+        self.fit_mode.addItem(_translate("MainWindow", "Быстрая аппроксимация"), "binned")
+        self.fit_mode.addItem(_translate("MainWindow", "Точная (curve_fit)"), "curve_fit")
+        self.fit_mode.setCurrentIndex(FIT_MODES.index(FIT_MODE))
+        self.joint_center.setText(_translate("MainWindow", "Уточнить центр"))
+        self.joint_center.setChecked(CENTER_MODE == "joint")
+        self.clipped.setText(_translate("MainWindow", "Отсев выбросов"))
+        self.clipped.setChecked(AVERAGE_MODE == "clipped")
+        self.btn_cancel.setText(_translate("MainWindow", "Отмена"))
+        self.btn_cancel.clicked.connect(self.cancel)
+        self.btn_clear.setText(_translate("MainWindow", "Очистить"))
+        self.btn_clear.clicked.connect(self.text.clear)
+        self.btn_save.setText(_translate("MainWindow", "Сохранить"))
+        self.btn_save.clicked.connect(self.save_file)
+
+    def open_file(self):
+        """
+        Remember the folder of user's choice for further use by the main script. Display selected directory in the
+        text browser
+        """
+        folder = QtWidgets.QFileDialog.getExistingDirectory(None, "Выберите директорию")
+        if folder:
+            self.text.append("Открыта директория {}".format(folder))
+            self.btn_start.setEnabled(True)  # enable "Запустить скрипт" button to work with inner images
+            self.folder = folder
+            QtWidgets.qApp.processEvents()
+
+    def finder(self):
+        """
+        Launch the calibration pipeline in the background CalibrationWorker thread, so the window stays responsive.
+        Worker messages are displayed in the text browser and its progress in the progress bar. "Запустить скрипт" and
+        "Открыть" buttons are disabled until the worker finishes, "Отмена" button stops it between frames
+        """
+        self.btn_start.setEnabled(False)
+        self.btn_open.setEnabled(False)
+        self.btn_save.setEnabled(False)
+        self.btn_cancel.setEnabled(True)
+        self.progress.setValue(0)
+        self.centers = []  # results of the previous run must not leak into the new one
+        self.coefficients = []
+        self.summary = None
+        center_mode = "joint" if self.joint_center.isChecked() else "com"
+        average_mode = "clipped" if self.clipped.isChecked() else "mean"
+        self.worker = CalibrationWorker(self.folder, self.fit_mode.currentData(), cache=ResultCache(),
+                                        center_mode=center_mode, average_mode=average_mode,
+                                        profile=os.environ.get(PROFILE_ENV))
+        self.worker.message.connect(self.text.append)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.succeeded.connect(self.store_results)
+        self.worker.finished.connect(self.worker_finished)
+        self.worker.start()
+
+    def cancel(self):
+        """
+        Ask the worker to stop, it finishes after the frames being read at the moment
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            self.btn_cancel.setEnabled(False)
+            self.text.append("Отмена обработки...")
+
+    def show_progress(self, done, total, note):
+        """
+        Display stage progress reported by the worker
+        """
+        self.progress.setMaximum(total)
+        self.progress.setValue(done)
+        self.progress.setFormat(note)
+
+    def store_results(self, summary):
+        """
+        Store formatted vignette centers and coefficients of successfully calibrated bands for save_file and enable
+        "Сохранить" button
+        """
+        self.centers = summary["centers"]
+        self.coefficients = summary["coefficients"]
+        self.summary = summary
+        self.btn_save.setEnabled(True)  # enable "Сохранить" button
+
+    def worker_finished(self):
+        self.btn_start.setEnabled(True)
+        self.btn_open.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
+        self.worker.wait()  # finished is emitted before the thread exits, the QThread must outlive it
+        self.worker = None
+
+    def save_file(self):
+        """
+        Save tags.json and tags.ini configuration files with vignette centers and coefficients of the last successful
+        run and calibration_report.json with its resource usage into the folder of user's choice
+        """
+        folder = QtWidgets.QFileDialog.getExistingDirectory(None, "Выберите директорию")
+        if folder:
+            write_tags(folder, self.centers, self.coefficients)
+            if self.summary is not None:
+                write_report(folder, self.summary)
+            self.text.append("Файлы были сохранены в директорию {}".format(folder))
+            self.btn_start.setEnabled(False)  # disable "Запустить скрипт" button until the new directory is opened
+            QtWidgets.qApp.processEvents()
+
+
+def run_gui():
+    app = QtWidgets.QApplication(sys.argv)  # initialize Qt app with system arguments
+    MainWindow = QtWidgets.QMainWindow()
+    ui = Ui_MainWindow()
+    ui.setupUi(MainWindow)
+    MainWindow.show()  # display Qt GUI using Ui_MainWindow Class methods
+    return app.exec_()  # finish the program once app is closed
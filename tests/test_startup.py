@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark import HEAVY_MODULES, STARTUP_BUDGET, measure_startup  # noqa: E402
+
+
+def test_startup_imports_no_heavy_modules():
+    times, modules = measure_startup(1)
+    assert not set(modules) & set(HEAVY_MODULES), "app imports {} on startup".format(", ".join(modules))
+
+
+def test_startup_within_budget():
+    times, _ = measure_startup(3)
+    assert min(times) < STARTUP_BUDGET, "import app takes {:.3f} s, budget is {} s".format(min(times), STARTUP_BUDGET)